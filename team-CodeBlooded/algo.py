@@ -1,42 +1,379 @@
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
 import geopandas as gpd
+import pandas as pd
+import shapely
+from shapely import STRtree
 from shapely.geometry import Polygon
-from shapely.ops import polygonize, unary_union
+from shapely.ops import unary_union
 import numpy as np
-import matplotlib.pyplot as plt
 
-def detect_roundabouts(roads_gdf, min_radius=10, max_radius=50, circularity_threshold=1, min_incoming=3):
+from profiling import StageProfiler, activate, active, call_profiler, stage
+from road_cache import load_roads, region_of_interest
+
+def count_incoming_roads(polygons, road_geoms):
+    """
+    Count the roads entering each candidate polygon using one STRtree query.
+
+    A road counts as incoming when it crosses the ring 2 m outside the polygon
+    edge and does not lie entirely inside the polygon shrunk by 1 m.
+
+    Parameters:
+    - polygons: array of candidate polygons
+    - road_geoms: array of road geometries
+
+    Returns:
+    - integer array with one count per polygon
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    if len(polygons) == 0:
+        return np.zeros(0, dtype=int)
+
+    edge_buffers = shapely.boundary(shapely.buffer(polygons, 2))  # narrow buffer around edge
+    inner_polygons = shapely.buffer(polygons, -1)
+
+    tree = STRtree(road_geoms)
+    poly_idx, road_idx = tree.query(edge_buffers, predicate="intersects")
+    inside = shapely.within(tree.geometries[road_idx], inner_polygons[poly_idx])
+
+    return np.bincount(poly_idx[~inside], minlength=len(polygons))
+
+def face_metrics(polygons):
+    """
+    Compute the shape metrics used to shortlist roundabout candidates.
+
+    Parameters:
+    - polygons: array of polygons
+
+    Returns:
+    - (radius, circularity, area) arrays, one value per polygon
+    """
+    area = shapely.area(polygons)
+    radius = np.sqrt(area / np.pi)
+    circularity = (4 * np.pi * area) / (shapely.length(polygons) ** 2)
+    return radius, circularity, area
+
+def candidate_mask(radius, circularity, area, min_radius, max_radius, circularity_threshold):
+    """Boolean mask of the faces passing the radius, circularity and area filters."""
+    return ((min_radius <= radius) & (radius <= max_radius) &
+            (circularity >= circularity_threshold) &
+            (area >= np.pi * (min_radius**2)))
+
+def max_face_perimeter(max_radius, circularity_threshold):
+    """
+    Longest perimeter a face can have and still pass the radius and
+    circularity filters: circularity = 4*pi*area / perimeter**2 and
+    area <= pi * max_radius**2.
+    """
+    if circularity_threshold <= 0:
+        return np.inf
+    return 2 * np.pi * max_radius / np.sqrt(circularity_threshold)
+
+def graph_faces(road_geoms, max_perimeter, snap_tolerance=0.01):
+    """
+    Find the small faces of the street graph without noding the whole network.
+
+    Segment endpoints are snapped to a grid of snap_tolerance and become graph
+    nodes. Each face is traced with the left-turn rule over directed edges
+    ordered by angle around their node, and the walk is abandoned as soon as
+    it is longer than max_perimeter. Only the short closed walks are
+    polygonized.
+
+    Parameters:
+    - road_geoms: array of road geometries
+    - max_perimeter: Longest face perimeter worth tracing
+    - snap_tolerance: Grid size used to merge nearly coincident endpoints
+
+    Returns:
+    - array of face polygons
+    """
+    lines = shapely.get_parts(np.asarray(road_geoms, dtype=object))
+    lines = lines[(shapely.get_type_id(lines) == 1) & (shapely.length(lines) > 0)]
+    if len(lines) == 0:
+        return np.empty(0, dtype=object)
+
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+    first = np.searchsorted(line_idx, np.arange(len(lines)))
+    last = np.append(first[1:], len(coords)) - 1
+
+    # directed edge 2k runs along line k, 2k + 1 runs against it
+    ends = np.empty((2 * len(lines), 2))
+    ends[0::2], ends[1::2] = coords[first], coords[last]
+    _, node = np.unique(np.round(ends / snap_tolerance), axis=0, return_inverse=True)
+    node = node.ravel()
+    heading = np.empty((2 * len(lines), 2))
+    heading[0::2] = coords[first + 1] - coords[first]
+    heading[1::2] = coords[last - 1] - coords[last]
+    angle = np.arctan2(heading[:, 1], heading[:, 0])
+    edge_length = np.repeat(shapely.length(lines), 2)
+
+    # twice the signed area swept by each edge, for telling enclosed faces from outer boundaries
+    along = line_idx[:-1] == line_idx[1:]
+    cross = coords[:-1, 0] * coords[1:, 1] - coords[1:, 0] * coords[:-1, 1]
+    line_cross = np.bincount(line_idx[:-1][along], weights=cross[along], minlength=len(lines))
+    edge_cross = np.empty(2 * len(lines))
+    edge_cross[0::2], edge_cross[1::2] = line_cross, -line_cross
+
+    # outgoing edges of every node, counter-clockwise
+    order = np.lexsort((angle, node))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    node_start = np.searchsorted(node[order], np.arange(node.max() + 1))
+    degree = np.bincount(node, minlength=len(node_start))
+    twin = np.arange(len(node)) ^ 1
+
+    # leaving the head node of edge e, turn onto the edge just clockwise of its twin
+    head = node[twin]
+    position = rank[twin] - node_start[head]
+    next_edge = order[node_start[head] + (position - 1) % degree[head]]
+
+    visited = np.zeros(len(node), dtype=bool)
+    faces = []
+    for start in range(len(node)):
+        if visited[start]:
+            continue
+        walk, perimeter, edge = [], 0.0, start
+        while not visited[edge] and perimeter <= max_perimeter:
+            visited[edge] = True
+            walk.append(edge)
+            perimeter += edge_length[edge]
+            edge = next_edge[edge]
+        # the left-turn walk runs counter-clockwise around enclosed faces only
+        if edge == start and perimeter <= max_perimeter and edge_cross[walk].sum() > 0:
+            faces.append(shapely.polygonize(lines[np.array(walk) // 2]))
+
+    return shapely.get_parts(np.array(faces, dtype=object))
+
+def find_faces(road_geoms, engine="polygonize", max_perimeter=np.inf):
+    """
+    Return the faces of the street network with the chosen engine.
+
+    "polygonize" nodes the whole network with unary_union and polygonizes it;
+    "graph" only traces faces up to max_perimeter long (see graph_faces).
+    """
+    if engine == "polygonize":
+        with stage("union", items=len(road_geoms)):
+            roads_union = unary_union(road_geoms)
+        with stage("polygonize") as record:
+            faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(roads_union)))
+            record["items"] = len(faces)
+        return faces
+    if engine == "graph":
+        with stage("graph_faces") as record:
+            faces = graph_faces(road_geoms, max_perimeter)
+            record["items"] = len(faces)
+        return faces
+    raise ValueError(f"Unknown engine: {engine!r} (expected 'polygonize' or 'graph')")
+
+def detect_roundabouts(roads_gdf, min_radius=10, max_radius=50, circularity_threshold=1, min_incoming=3,
+                       engine="polygonize"):
+    """
+    Detect roundabouts as small, nearly circular faces of the street network
+    with at least min_incoming roads entering them.
+
+    engine selects how faces are found: "polygonize" nodes the whole network
+    with unary_union and polygonizes it, "graph" traces short cycles of the
+    endpoint graph (see graph_faces) and only polygonizes those.
+    """
     roads_gdf = roads_gdf[roads_gdf.is_valid].copy()
-    roads_union = unary_union(roads_gdf.geometry)
-    potential_roundabouts = list(polygonize(roads_union))
-    candidates = []
+    potential_roundabouts = find_faces(roads_gdf.geometry.values, engine,
+                                       max_face_perimeter(max_radius, circularity_threshold))
     
-    for poly in potential_roundabouts:
-        center = poly.centroid
-        radius = np.sqrt(poly.area / np.pi)
-        circularity = (4 * np.pi * poly.area) / (poly.length ** 2)
-        
-        if not (min_radius <= radius <= max_radius and
-                circularity >= circularity_threshold and
-                poly.area >= np.pi * (min_radius**2)):
-            continue
-        
-        # roads intersect the roundabout boundary
-        edge_buffer = poly.buffer(2).boundary  # narrow buffer around edge
-        intersecting_roads = roads_gdf[roads_gdf.geometry.intersects(edge_buffer)]
-        incoming_roads = intersecting_roads[~intersecting_roads.geometry.within(poly.buffer(-1))]
-        
-        if len(incoming_roads) >= min_incoming:
-            candidates.append({
-                'geometry': poly,
-                'radius': radius,
-                'circularity': circularity,
-                'center': center,
-                'incoming_streets': len(incoming_roads)
-            })
+    with stage("candidate_filter") as record:
+        radius, circularity, area = face_metrics(potential_roundabouts)
+        keep = candidate_mask(radius, circularity, area, min_radius, max_radius, circularity_threshold)
+        shortlisted = potential_roundabouts[keep]
+        record["items"] = len(shortlisted)
     
-    return gpd.GeoDataFrame(candidates, crs=roads_gdf.crs)
+    # roads intersect the roundabout boundary, counted for all shortlisted polygons at once
+    with stage("incoming_roads") as record:
+        incoming_counts = count_incoming_roads(shortlisted, roads_gdf.geometry.values)
+        accepted = incoming_counts >= min_incoming
+        record["items"] = int(accepted.sum())
+    
+    return gpd.GeoDataFrame({
+        'geometry': shortlisted[accepted],
+        'radius': radius[keep][accepted],
+        'circularity': circularity[keep][accepted],
+        'center': shapely.centroid(shortlisted[accepted]),
+        'incoming_streets': incoming_counts[accepted]
+    }, geometry='geometry', crs=roads_gdf.crs)
+
+def safe_halo(max_radius, circularity_threshold):
+    """
+    Smallest tile halo that keeps tiled detection identical to a single run.
+
+    A face that passes the filters has perimeter at most
+    2 * pi * max_radius / sqrt(circularity_threshold), so no point of it is
+    further than half of that from its centroid. The extra 2 m covers the
+    ring used to count incoming roads.
+    """
+    if circularity_threshold <= 0:
+        raise ValueError("circularity_threshold must be > 0 to derive a tile halo; pass halo explicitly")
+    return max_face_perimeter(max_radius, circularity_threshold) / 2 + 2
+
+def tile_windows(bounds, tile_size):
+    """Split (minx, miny, maxx, maxy) into square tile cores of side tile_size."""
+    minx, miny, maxx, maxy = bounds
+    nx = int((maxx - minx) // tile_size) + 1
+    ny = int((maxy - miny) // tile_size) + 1
+    return [(minx + i * tile_size, miny + j * tile_size,
+             minx + (i + 1) * tile_size, miny + (j + 1) * tile_size)
+            for i in range(nx) for j in range(ny)]
 
-def add_roundabout_attribute(roads_gdf, roundabouts_gdf, buffer_distance=5):
+def _detect_tile(task):
+    """
+    Run detect_roundabouts on one tile and keep the roundabouts it owns.
+
+    Returns the roundabouts and, when profile is "basic" or "trace", the
+    stage records of the tile (an empty list otherwise).
+    """
+    tile_roads, core, params, profile = task
+    profiler = StageProfiler(trace_python_memory=profile == "trace") if profile else None
+    with activate(profiler):
+        found = detect_roundabouts(tile_roads, **params)
+    records = profiler.stages if profiler else []
+    if len(found) == 0:
+        return found, records
+
+    # a roundabout belongs to the tile whose half-open core contains its centroid
+    cx = shapely.get_x(found['center'].values)
+    cy = shapely.get_y(found['center'].values)
+    owned = (core[0] <= cx) & (cx < core[2]) & (core[1] <= cy) & (cy < core[3])
+    return found[owned], records
+
+def detect_roundabouts_tiled(roads_gdf, min_radius=10, max_radius=50, circularity_threshold=1,
+                             min_incoming=3, engine="polygonize", tile_size=5000, workers=None, halo=None):
+    """
+    Partitioned version of detect_roundabouts for large street layers.
+
+    The projected extent is split into tiles of tile_size metres. Each tile is
+    processed in a worker process together with every road within `halo` of
+    it, and a roundabout is kept only by the tile that contains its centroid,
+    so faces crossing tile edges are reported once. With the default halo
+    (see safe_halo) the result is the same set of roundabouts as
+    detect_roundabouts on the whole layer.
+
+    Parameters:
+    - roads_gdf: GeoDataFrame of roads in a projected CRS
+    - min_radius, max_radius, circularity_threshold, min_incoming, engine: as in detect_roundabouts
+    - tile_size: Side length of a tile core in CRS units
+    - workers: Number of worker processes (None = all cores, 1 = run in this process)
+    - halo: Overlap added around each tile; defaults to safe_halo()
+
+    Returns:
+    - GeoDataFrame of detected roundabouts
+    """
+    if halo is None:
+        halo = safe_halo(max_radius, circularity_threshold)
+    if halo < max_radius:
+        raise ValueError(f"halo ({halo}) must be at least max_radius ({max_radius})")
+
+    roads_gdf = roads_gdf[roads_gdf.is_valid]
+    params = dict(min_radius=min_radius, max_radius=max_radius,
+                  circularity_threshold=circularity_threshold, min_incoming=min_incoming,
+                  engine=engine)
+    if len(roads_gdf) == 0:
+        return detect_roundabouts(roads_gdf, **params)
+
+    cores = tile_windows(roads_gdf.total_bounds, tile_size)
+    return detect_in_tiles(roads_gdf, cores, halo, workers, **params)
+
+def detect_in_tiles(roads_gdf, cores, halo, workers=None, **params):
+    """
+    Detect roundabouts owned by the given tile cores.
+
+    Each (minx, miny, maxx, maxy) core is processed with the roads within
+    `halo` of it and keeps the roundabouts whose centroid falls inside it.
+    When a profiler is active, each tile's stages are recorded in its worker
+    and added to it with the tile's index.
+
+    Parameters:
+    - roads_gdf: GeoDataFrame of valid roads in a projected CRS
+    - cores: List of tile cores
+    - halo: Overlap added around each core
+    - workers: Number of worker processes (None = all cores, 1 = run in this process)
+    - params: Keyword arguments for detect_roundabouts
+
+    Returns:
+    - GeoDataFrame of the roundabouts owned by the cores
+    """
+    profiler = active()
+    profile = None
+    if profiler is not None:
+        profile = "trace" if profiler.trace_python_memory else "basic"
+
+    tasks = []
+    if len(cores):
+        windows = shapely.box(*np.array(cores).T)
+        windows = shapely.buffer(windows, halo, join_style="mitre")
+        tile_idx, road_idx = STRtree(roads_gdf.geometry.values).query(windows, predicate="intersects")
+        for i, core in enumerate(cores):
+            members = road_idx[tile_idx == i]
+            if len(members):
+                tasks.append((roads_gdf.iloc[np.sort(members)], core, params, profile))
+
+    if not tasks:
+        return detect_roundabouts(roads_gdf.iloc[:0], **params)
+    with stage("detect_tiled", items=len(tasks)):
+        if workers == 1 or len(tasks) == 1:
+            results = [_detect_tile(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_detect_tile, tasks))
+
+    if profiler is not None:
+        for tile, (_, records) in enumerate(results):
+            profiler.add(records, tile=tile)
+    parts = [found for found, _ in results]
+    return gpd.GeoDataFrame(pd.concat(parts, ignore_index=True),
+                            geometry='geometry', crs=roads_gdf.crs)
+
+def compare_engines(roads_gdf, min_iou=0.9, **params):
+    """
+    Run both detection engines on the same roads and compare them.
+
+    A graph-engine roundabout matches a polygonize-engine roundabout when
+    their intersection over union is at least min_iou. Recall is the share of
+    polygonize roundabouts that were matched, precision the share of graph
+    roundabouts that match one.
+
+    Returns:
+    - (report, results): report is a dict of runtimes, counts, recall and
+      precision; results maps engine name to its GeoDataFrame
+    """
+    results, runtimes = {}, {}
+    for engine in ("polygonize", "graph"):
+        start = time.perf_counter()
+        results[engine] = detect_roundabouts(roads_gdf, engine=engine, **params)
+        runtimes[engine] = time.perf_counter() - start
+
+    reference = results["polygonize"].geometry.values
+    candidate = results["graph"].geometry.values
+    ref_idx, cand_idx = STRtree(candidate).query(reference, predicate="intersects")
+    overlap = shapely.area(shapely.intersection(reference[ref_idx], candidate[cand_idx]))
+    iou = overlap / shapely.area(shapely.union(reference[ref_idx], candidate[cand_idx]))
+    matched = iou >= min_iou
+
+    report = {
+        "engines": {engine: {"runtime_s": round(runtimes[engine], 3),
+                             "roundabouts": len(results[engine])}
+                    for engine in results},
+        "recall": len(np.unique(ref_idx[matched])) / len(reference) if len(reference) else 1.0,
+        "precision": len(np.unique(cand_idx[matched])) / len(candidate) if len(candidate) else 1.0,
+        "speedup": runtimes["polygonize"] / runtimes["graph"] if runtimes["graph"] else float("inf"),
+    }
+    return report, results
+
+# Roundabout count from which add_roundabout_attribute(method="auto") skips the
+# union; see benchmark.py --crossover
+INDEXED_ATTRIBUTE_MIN_ROUNDABOUTS = 2
+
+def add_roundabout_attribute(roads_gdf, roundabouts_gdf, buffer_distance=5, method="auto"):
     """
     Add a roundabout attribute to the roads layer indicating if each street
     intersects with or is near a roundabout.
@@ -45,6 +382,10 @@ def add_roundabout_attribute(roads_gdf, roundabouts_gdf, buffer_distance=5):
     - roads_gdf: GeoDataFrame of roads/streets
     - roundabouts_gdf: GeoDataFrame of detected roundabouts
     - buffer_distance: Distance to buffer roundabouts for intersection check
+    - method: "union" tests every road against the union of all buffered
+      roundabouts, "index" tests each road only against the buffered
+      roundabouts an STRtree finds near it. Both give the same result;
+      "auto" picks "index" from INDEXED_ATTRIBUTE_MIN_ROUNDABOUTS roundabouts on.
     
     Returns:
     - roads_gdf with new 'has_roundabout' column
@@ -59,74 +400,109 @@ def add_roundabout_attribute(roads_gdf, roundabouts_gdf, buffer_distance=5):
         print("No roundabouts detected - all streets marked as False")
         return roads_with_attr
     
+    if method == "auto":
+        method = "index" if len(roundabouts_gdf) >= INDEXED_ATTRIBUTE_MIN_ROUNDABOUTS else "union"
+    
     # Buffer roundabouts slightly to catch nearby streets
     buffered_roundabouts = roundabouts_gdf.geometry.buffer(buffer_distance)
     
-    # Create a union of all buffered roundabouts for efficient intersection
-    roundabouts_union = unary_union(buffered_roundabouts)
-    
-    # Check which roads intersect with any roundabout
-    intersects_roundabout = roads_with_attr.geometry.intersects(roundabouts_union)
+    if method == "union":
+        # Create a union of all buffered roundabouts for efficient intersection
+        roundabouts_union = unary_union(buffered_roundabouts)
+        
+        # Check which roads intersect with any roundabout
+        intersects_roundabout = roads_with_attr.geometry.intersects(roundabouts_union)
+    elif method == "index":
+        # Bulk query: each road is only tested against the buffers whose extent it overlaps
+        road_idx, _ = STRtree(buffered_roundabouts.values).query(roads_with_attr.geometry.values,
+                                                                 predicate="intersects")
+        intersects_roundabout = np.zeros(len(roads_with_attr), dtype=bool)
+        intersects_roundabout[road_idx] = True
+    else:
+        raise ValueError(f"Unknown method: {method!r} (expected 'auto', 'union' or 'index')")
     
     # Update the attribute: True for streets that intersect roundabouts, False for others
     roads_with_attr.loc[intersects_roundabout, 'has_roundabout'] = True
     
-    # Print summary statistics
+    print_roundabout_summary(roads_with_attr)
+    
+    return roads_with_attr
+
+def print_roundabout_summary(roads_with_attr):
+    """Print how many streets carry the has_roundabout attribute."""
     total_streets = len(roads_with_attr)
     streets_with_roundabouts = sum(roads_with_attr['has_roundabout'])
     
     print(f"Total streets: {total_streets}")
     print(f"Streets with roundabouts: {streets_with_roundabouts}")
     print(f"Streets without roundabouts: {total_streets - streets_with_roundabouts}")
-    print(f"Percentage with roundabouts: {streets_with_roundabouts/total_streets*100:.1f}%")
-    
-    return roads_with_attr
-
-# Load and project roads
-roads = gpd.read_file("data/raw/Streets.shp").to_crs("EPSG:3059")
+    if total_streets:
+        print(f"Percentage with roundabouts: {streets_with_roundabouts/total_streets*100:.1f}%")
 
-# Detect roundabouts
-roundabouts = detect_roundabouts(roads, min_radius=10, max_radius=300, 
-                                circularity_threshold=0.95, min_incoming=3)
+def classify_road_geometries(road_geoms, roundabout_geoms, buffer_distance=5, near_distance=15):
+    """
+    Compute has_roundabout and roundabout_type for every road in one indexed pass.
 
-# Add roundabout attribute to roads
-roads_with_roundabouts = add_roundabout_attribute(roads, roundabouts, buffer_distance=10)
+    The buffered roundabouts go into an STRtree that is queried once with all
+    roads; the within/boundary/buffer predicates are then evaluated only on
+    the road-roundabout pairs that query returns. Precedence matches the
+    original per-roundabout loop: a road within any roundabout is type 1,
+    otherwise the first roundabout (in input order) it comes near decides
+    between 2 (touches its boundary) and 3 (only within near_distance).
 
-# Visualization
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 8))
+    Parameters:
+    - road_geoms: array of road geometries
+    - roundabout_geoms: array of roundabout polygons
+    - buffer_distance: Buffer used for has_roundabout
+    - near_distance: Buffer used for roundabout_type 3
 
-# Plot 1: Original detection
-roads.plot(ax=ax1, color='gray', linewidth=0.5, alpha=0.7)
-roundabouts.plot(ax=ax1, color='red', alpha=0.6)
-ax1.set_title(f"Detected Roundabouts: {len(roundabouts)}")
+    Returns:
+    - (has_roundabout, roundabout_type) arrays, one value per road
+    """
+    road_geoms = np.asarray(road_geoms, dtype=object)
+    roundabout_geoms = np.asarray(roundabout_geoms, dtype=object)
+    has_roundabout = np.zeros(len(road_geoms), dtype=bool)
+    roundabout_type = np.zeros(len(road_geoms), dtype=int)
+    if len(road_geoms) == 0 or len(roundabout_geoms) == 0:
+        return has_roundabout, roundabout_type
 
-# Plot 2: Streets colored by roundabout attribute
-streets_no_roundabout = roads_with_roundabouts[roads_with_roundabouts['has_roundabout'] == False]
-streets_with_roundabout = roads_with_roundabouts[roads_with_roundabouts['has_roundabout'] == True]
+    has_buffers = shapely.buffer(roundabout_geoms, buffer_distance)
+    near_buffers = shapely.buffer(roundabout_geoms, near_distance)
+    search_buffers = near_buffers if near_distance >= buffer_distance else has_buffers
 
-streets_no_roundabout.plot(ax=ax2, color='gray', linewidth=0.5, alpha=0.7, label='No roundabout')
-streets_with_roundabout.plot(ax=ax2, color='blue', linewidth=1, label='Has roundabout')
-roundabouts.plot(ax=ax2, color='red', alpha=0.6, label='Roundabouts')
+    road_idx, rb_idx = STRtree(search_buffers).query(road_geoms, predicate="intersects")
+    order = np.lexsort((rb_idx, road_idx))
+    road_idx, rb_idx = road_idx[order], rb_idx[order]
+    pair_roads = road_geoms[road_idx]
 
-ax2.set_title("Streets Classified by Roundabout Presence")
-ax2.legend()
+    has_pair = shapely.intersects(pair_roads, has_buffers[rb_idx])
+    has_roundabout[road_idx[has_pair]] = True
 
-plt.tight_layout()
-plt.show()
+    near_pair = shapely.intersects(pair_roads, near_buffers[rb_idx])
+    near_roads, near_rbs = road_idx[near_pair], rb_idx[near_pair]
+    first_roads, first = np.unique(near_roads, return_index=True)
+    touches = shapely.intersects(road_geoms[first_roads],
+                                 shapely.boundary(roundabout_geoms[near_rbs[first]]))
+    roundabout_type[first_roads] = np.where(touches, 2, 3)
 
-# Save the updated roads layer with roundabout attribute
-roads_with_roundabouts.to_file("roads_with_roundabout_attribute.gpkg", 
-                              layer='roads_classified', driver="GPKG")
+    within_pair = shapely.within(road_geoms[near_roads], roundabout_geoms[near_rbs])
+    roundabout_type[near_roads[within_pair]] = 1
 
-# Also save roundabouts separately
-roundabouts.to_file("detected_roundabouts.gpkg", 
-                   layer='roundabouts', driver="GPKG")
+    return has_roundabout, roundabout_type
 
-print("\nFiles saved:")
-print("- roads_with_roundabout_attribute.gpkg (roads with has_roundabout column)")
-print("- detected_roundabouts.gpkg (detected roundabouts)")
+def classify_roads(roads_gdf, roundabouts_gdf, buffer_distance=5, near_distance=15):
+    """
+    Add both 'has_roundabout' and 'roundabout_type' to the roads layer,
+    scanning the roads once (see classify_road_geometries).
+    """
+    roads_classified = roads_gdf.copy()
+    roundabout_geoms = roundabouts_gdf.geometry.values if len(roundabouts_gdf) else []
+    has_roundabout, roundabout_type = classify_road_geometries(
+        roads_classified.geometry.values, roundabout_geoms, buffer_distance, near_distance)
+    roads_classified['has_roundabout'] = has_roundabout
+    roads_classified['roundabout_type'] = roundabout_type
+    return roads_classified
 
-# Optional: Create a more detailed classification
 def add_detailed_roundabout_attribute(roads_gdf, roundabouts_gdf):
     """
     Add a more detailed roundabout classification:
@@ -135,28 +511,238 @@ def add_detailed_roundabout_attribute(roads_gdf, roundabouts_gdf):
     2 = Intersects with roundabout boundary
     3 = Near roundabout (within buffer)
     """
-    roads_detailed = roads_gdf.copy()
-    roads_detailed['roundabout_type'] = 0
-    
-    if len(roundabouts_gdf) == 0:
-        return roads_detailed
-    
-    for idx, roundabout in roundabouts_gdf.iterrows():
-        # Streets within the roundabout
-        within_mask = roads_detailed.geometry.within(roundabout.geometry)
-        roads_detailed.loc[within_mask, 'roundabout_type'] = 1
-        
-        # Streets intersecting the boundary
-        intersects_mask = roads_detailed.geometry.intersects(roundabout.geometry.boundary)
-        roads_detailed.loc[intersects_mask & (roads_detailed['roundabout_type'] == 0), 'roundabout_type'] = 2
-        
-        # Streets near the roundabout (buffered)
-        near_mask = roads_detailed.geometry.intersects(roundabout.geometry.buffer(15))
-        roads_detailed.loc[near_mask & (roads_detailed['roundabout_type'] == 0), 'roundabout_type'] = 3
-    
-    return roads_detailed
+    return classify_roads(roads_gdf, roundabouts_gdf).drop(columns='has_roundabout')
+
+def plot_results(roads_with_roundabouts, roundabouts):
+    """Show detected roundabouts and the classified streets side by side."""
+    import matplotlib.pyplot as plt
+
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 8))
+
+    # Plot 1: Original detection
+    roads_with_roundabouts.plot(ax=ax1, color='gray', linewidth=0.5, alpha=0.7)
+    roundabouts.plot(ax=ax1, color='red', alpha=0.6)
+    ax1.set_title(f"Detected Roundabouts: {len(roundabouts)}")
+
+    # Plot 2: Streets colored by roundabout attribute
+    streets_no_roundabout = roads_with_roundabouts[roads_with_roundabouts['has_roundabout'] == False]
+    streets_with_roundabout = roads_with_roundabouts[roads_with_roundabouts['has_roundabout'] == True]
+
+    streets_no_roundabout.plot(ax=ax2, color='gray', linewidth=0.5, alpha=0.7, label='No roundabout')
+    streets_with_roundabout.plot(ax=ax2, color='blue', linewidth=1, label='Has roundabout')
+    roundabouts.plot(ax=ax2, color='red', alpha=0.6, label='Roundabouts')
+
+    ax2.set_title("Streets Classified by Roundabout Presence")
+    ax2.legend()
+
+    plt.tight_layout()
+    plt.show()
+
+# Output format name -> (file extension, OGR driver or None for GeoParquet)
+OUTPUT_FORMATS = {
+    "gpkg": (".gpkg", "GPKG"),
+    "parquet": (".parquet", None),
+    "fgb": (".fgb", "FlatGeobuf"),
+}
+
+def write_layer(gdf, output_dir, name, layer, fmt="gpkg"):
+    """
+    Write one output layer in the chosen format and return its path.
+
+    Extra geometry columns such as 'center' are stored as WKT, which is what
+    the GeoPackage driver did with them already.
+    """
+    extension, driver = OUTPUT_FORMATS[fmt]
+    path = Path(output_dir) / f"{name}{extension}"
+    gdf = gdf.copy()
+    for column in gdf.columns:
+        if column != gdf.geometry.name and shapely.is_geometry(gdf[column].values).any():
+            gdf[column] = gdf[column].astype(str)
+
+    with stage(f"write:{name}", items=len(gdf)):
+        if driver is None:
+            gdf.to_parquet(path)
+        elif driver == "GPKG":
+            gdf.to_file(path, layer=layer, driver=driver)
+        else:
+            gdf.to_file(path, driver=driver)
+    return path
+
+def run_pipeline(input_path, output_dir=".", fmt="gpkg", crs="EPSG:3059", plot=False,
+                 detection_params=None, buffer_distance=10, engine="polygonize",
+                 tile_size=None, workers=None, compare=False, cache_dir=None, columns=None, roi=None):
+    """
+    Load a street shapefile, detect roundabouts, classify the roads and write
+    the three output layers.
+
+    Parameters:
+    - input_path: Street layer readable by geopandas
+    - output_dir: Directory for the output files (created if missing)
+    - fmt: One of OUTPUT_FORMATS
+    - crs: Projected CRS the detection runs in
+    - plot: Show the matplotlib figure (imports matplotlib only when True)
+    - detection_params: Keyword arguments for detect_roundabouts
+    - buffer_distance: Buffer used for has_roundabout
+    - engine: Detection engine, "polygonize" or "graph"
+    - tile_size, workers: Use detect_roundabouts_tiled when tile_size is set
+    - compare: Also run compare_engines and print its report
+    - cache_dir: GeoParquet cache for the projected roads (see road_cache.load_roads)
+    - columns: Attribute columns to keep from the input (None = all)
+    - roi: Region of interest in crs (see road_cache.region_of_interest). Only
+      roads within the tile halo of it are read; the outputs hold the
+      roundabouts whose centroid lies in it and the roads that intersect it.
+
+    Returns:
+    - dict mapping layer name to the written path
+    """
+    detection_params = detection_params or {}
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Load and project roads, from the cache when one is configured
+    load_region = None
+    if roi is not None:
+        halo = safe_halo(detection_params.get('max_radius', 50), detection_params.get('circularity_threshold', 1))
+        load_region = shapely.buffer(roi, halo + buffer_distance)
+    roads = load_roads(input_path, crs, cache_dir=cache_dir, columns=columns, roi=load_region)
+
+    # Detect roundabouts
+    if compare:
+        engine_report, engine_results = compare_engines(roads, **detection_params)
+        roundabouts = engine_results[engine]
+        for name, stats in engine_report["engines"].items():
+            print(f"{name} engine: {stats['roundabouts']} roundabouts in {stats['runtime_s']:.2f}s")
+        print(f"Graph engine recall: {engine_report['recall']:.1%}, "
+              f"precision: {engine_report['precision']:.1%}, speedup: {engine_report['speedup']:.1f}x")
+    elif tile_size:
+        roundabouts = detect_roundabouts_tiled(roads, engine=engine, tile_size=tile_size,
+                                               workers=workers, **detection_params)
+    else:
+        roundabouts = detect_roundabouts(roads, engine=engine, **detection_params)
+
+    # Add the roundabout attribute and the detailed classification to roads in one pass
+    with stage("classify_roads", items=len(roads)):
+        roads_classified = classify_roads(roads, roundabouts, buffer_distance=buffer_distance)
+
+    # Drop what the halo around the region of interest pulled in
+    if roi is not None:
+        roundabouts = roundabouts[shapely.intersects(roundabouts['center'].values, roi)].reset_index(drop=True)
+        roads_classified = roads_classified[roads_classified.intersects(roi)].reset_index(drop=True)
+    roads_with_roundabouts = roads_classified.drop(columns='roundabout_type')
+    roads_detailed = roads_classified.drop(columns='has_roundabout')
+    print_roundabout_summary(roads_with_roundabouts)
+
+    if plot:
+        with stage("plot"):
+            plot_results(roads_with_roundabouts, roundabouts)
+
+    outputs = {
+        "roads_classified": write_layer(roads_with_roundabouts, output_dir,
+                                        "roads_with_roundabout_attribute", "roads_classified", fmt),
+        "roundabouts": write_layer(roundabouts, output_dir,
+                                   "detected_roundabouts", "roundabouts", fmt),
+        "roads_detailed": write_layer(roads_detailed, output_dir,
+                                      "roads_detailed_roundabout_classification", "roads_detailed", fmt),
+    }
+
+    print(f"\nFiles saved for {input_path}:")
+    for path in outputs.values():
+        print(f"- {path}")
+
+    return outputs
+
+def _run_batch_item(item):
+    input_path, kwargs, profile = item
+    if not profile:
+        return run_pipeline(input_path, **kwargs), None
+
+    profiler = StageProfiler(trace_python_memory=profile == "trace")
+    with activate(profiler):
+        outputs = run_pipeline(input_path, **kwargs)
+    return outputs, dict(input=str(input_path), **profiler.report())
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Detect roundabouts in a street network and classify its roads.")
+    parser.add_argument("inputs", nargs="*", default=["data/raw/Streets.shp"],
+                        help="Street shapefile(s) to process (default: data/raw/Streets.shp)")
+    parser.add_argument("-o", "--output-dir", default=".",
+                        help="Output directory; with several inputs each gets its own subdirectory")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="gpkg",
+                        help="Output format: GeoPackage, GeoParquet or FlatGeobuf")
+    parser.add_argument("--no-plot", action="store_true",
+                        help="Headless mode: do not import matplotlib or show plots")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of input files processed in parallel")
+    parser.add_argument("--crs", default="EPSG:3059", help="Projected CRS used for detection")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Cache the projected roads as GeoParquet here and reuse them on later runs")
+    parser.add_argument("--columns", nargs="+", default=None,
+                        help="Attribute columns to keep from the input (default: all)")
+    parser.add_argument("--bbox", type=float, nargs=4, default=None, metavar=("MINX", "MINY", "MAXX", "MAXY"),
+                        help="Only process roads in this bounding box (read with the spatial index)")
+    parser.add_argument("--bbox-crs", default=None, help="CRS of --bbox (default: --crs)")
+    parser.add_argument("--roi", default=None,
+                        help="Vector file whose polygons restrict processing to a region of interest")
+    parser.add_argument("--min-radius", type=float, default=10)
+    parser.add_argument("--max-radius", type=float, default=300)
+    parser.add_argument("--circularity-threshold", type=float, default=0.95)
+    parser.add_argument("--min-incoming", type=int, default=3)
+    parser.add_argument("--buffer-distance", type=float, default=10)
+    parser.add_argument("--engine", choices=["polygonize", "graph"], default="polygonize")
+    parser.add_argument("--tile-size", type=float, default=None,
+                        help="Run tiled detection with tiles of this size (CRS units)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes for tiled detection")
+    parser.add_argument("--compare-engines", action="store_true",
+                        help="Run both engines and print the recall/runtime comparison")
+    parser.add_argument("--profile-report", default=None,
+                        help="Write per-stage wall/CPU time, memory and item counts as JSON to this path")
+    parser.add_argument("--trace-python-memory", action="store_true",
+                        help="Also record the peak Python allocation per stage (slower)")
+    parser.add_argument("--cprofile", default=None, help="Dump cProfile stats of the run to this path")
+    parser.add_argument("--pyinstrument", default=None,
+                        help="Write a pyinstrument HTML report of the run to this path")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    detection_params = dict(min_radius=args.min_radius, max_radius=args.max_radius,
+                            circularity_threshold=args.circularity_threshold,
+                            min_incoming=args.min_incoming)
+    roi = region_of_interest(args.crs, bbox=args.bbox, roi_path=args.roi, bbox_crs=args.bbox_crs)
+    batch = len(args.inputs) > 1
+    if batch and not args.no_plot:
+        print("Plots are disabled when processing several inputs")
+
+    profile = None
+    if args.profile_report:
+        profile = "trace" if args.trace_python_memory else "basic"
+
+    items = []
+    for input_path in args.inputs:
+        output_dir = Path(args.output_dir)
+        if batch:
+            source = Path(input_path)
+            output_dir = output_dir / f"{source.parent.name}_{source.stem}".replace(" ", "_")
+        items.append((input_path, dict(
+            output_dir=output_dir, fmt=args.format, crs=args.crs,
+            plot=not (args.no_plot or batch), detection_params=detection_params,
+            buffer_distance=args.buffer_distance, engine=args.engine,
+            tile_size=args.tile_size, workers=args.workers, compare=args.compare_engines,
+            cache_dir=args.cache_dir, columns=args.columns, roi=roi), profile))
+
+    with call_profiler(args.cprofile, args.pyinstrument):
+        if args.jobs > 1 and batch:
+            with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+                results = list(pool.map(_run_batch_item, items))
+        else:
+            results = [_run_batch_item(item) for item in items]
+
+    if args.profile_report:
+        with open(args.profile_report, "w") as f:
+            json.dump({"runs": [report for _, report in results]}, f, indent=2)
+        print(f"Profile report saved to {args.profile_report}")
+    return [outputs for outputs, _ in results]
 
-# Create detailed classification (optional)
-roads_detailed = add_detailed_roundabout_attribute(roads, roundabouts)
-roads_detailed.to_file("roads_detailed_roundabout_classification.gpkg", 
-                      layer='roads_detailed', driver="GPKG")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely import STRtree
+
+from algo import add_roundabout_attribute, classify_roads, detect_roundabouts
+from profiling import StageProfiler, activate, peak_rss_mb
+
+DEFAULT_SIZES = (10_000, 100_000, 500_000, 1_000_000, 2_000_000)
+DEFAULT_CROSSOVER_COUNTS = (1, 4, 16, 64, 256, 1024, 4096)
+
+def generate_network(n_segments, seed=0, block=200.0, roundabout_share=0.3, arterial_every=5,
+                     min_radius=15.0, max_radius=60.0, ring_vertices=64, crs="EPSG:3059"):
+    """
+    Build a projected synthetic street network of roughly n_segments segments.
+
+    The network is a square grid of blocks whose edges are split at their
+    midpoints, arterial lines running through the middle of every
+    arterial_every-th block row, and circular roundabouts planted in the
+    centre of a random share of the remaining blocks. Each roundabout has a
+    random radius in [min_radius, max_radius] and 1-4 arms that join the
+    midpoints of the surrounding block edges; its ring is split into arcs
+    where the arms meet it.
+
+    Returns:
+    - (roads, truth): GeoDataFrame of road segments and GeoDataFrame of the
+      planted roundabouts with their 'radius' and 'arms'
+    """
+    rng = np.random.default_rng(seed)
+    n = max(2, int(np.ceil(np.sqrt(n_segments / 4))))
+    half = block / 2
+
+    # grid edges, each split in two at its midpoint
+    i, j, k = np.meshgrid(np.arange(n + 1), np.arange(n), np.arange(2), indexing="ij")
+    i, j, k = i.ravel(), j.ravel(), k.ravel()
+    start, end = j * block + k * half, j * block + (k + 1) * half
+    grid = np.concatenate([
+        np.stack([np.c_[i * block, start], np.c_[i * block, end]], axis=1),  # vertical
+        np.stack([np.c_[start, i * block], np.c_[end, i * block]], axis=1),  # horizontal
+    ])
+
+    # arterials through the middle of some block rows, one segment per block
+    rows = np.arange(0, n, arterial_every)
+    r, c = np.meshgrid(rows, np.arange(n), indexing="ij")
+    r, c = r.ravel(), c.ravel()
+    y = r * block + half
+    arterials = np.stack([np.c_[c * block, y], np.c_[(c + 1) * block, y]], axis=1)
+
+    # roundabouts in the centre of blocks that no arterial crosses
+    bx, by = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+    free = (by % arterial_every) != 0
+    blocks = np.flatnonzero(free.ravel() & (rng.random(n * n) < roundabout_share))
+    centers = np.c_[bx.ravel()[blocks] * block + half, by.ravel()[blocks] * block + half]
+    radii = rng.uniform(min_radius, max_radius, len(blocks))
+    arm_masks = rng.random((len(blocks), 4)) < 0.6
+    arm_masks[~arm_masks.any(axis=1), 0] = True
+
+    # arm directions are exact so arms meet the split grid edges in shared nodes
+    directions = np.array([[1.0, 0.0], [0.0, 1.0], [-1.0, 0.0], [0.0, -1.0]])
+    lines, truth_rings = [], []
+    for center, radius, mask in zip(centers, radii, arm_masks):
+        arms = np.flatnonzero(mask)
+        ring = []
+        for idx, quarter in enumerate(arms):
+            following = arms[(idx + 1) % len(arms)]
+            span = (following - quarter) % 4 or 4
+            t = np.linspace(quarter, quarter + span, span * ring_vertices // 4 + 1) * (np.pi / 2)
+            arc = center + radius * np.c_[np.cos(t), np.sin(t)]
+            arc[0] = center + radius * directions[quarter]
+            arc[-1] = center + radius * directions[following]
+            lines.append(arc)
+            ring.append(arc[:-1])
+            lines.append(np.array([center + radius * directions[quarter],
+                                   center + half * directions[quarter]]))
+        truth_rings.append(np.vstack(ring))
+
+    geoms = np.concatenate([
+        shapely.linestrings(grid),
+        shapely.linestrings(arterials),
+        np.array([shapely.LineString(coords) for coords in lines], dtype=object),
+    ])
+    roads = gpd.GeoDataFrame({"LINK_ID": np.arange(len(geoms))}, geometry=geoms, crs=crs)
+    truth = gpd.GeoDataFrame({"radius": radii, "arms": arm_masks.sum(axis=1)},
+                             geometry=[shapely.Polygon(ring) for ring in truth_rings], crs=crs)
+    return roads, truth
+
+def score_detections(detected, truth, min_radius, max_radius, min_incoming, tolerance=1.0):
+    """
+    Precision and recall of detected roundabouts against the planted ones
+    that satisfy the detection thresholds. A detection matches a planted
+    roundabout when their centroids are within tolerance.
+    """
+    expected = truth[(truth["arms"] >= min_incoming) &
+                     (truth["radius"] >= min_radius) & (truth["radius"] <= max_radius)]
+    expected_centers = shapely.centroid(expected.geometry.values)
+    detected_centers = shapely.centroid(detected.geometry.values)
+    det_idx, exp_idx = STRtree(expected_centers).query(detected_centers, predicate="dwithin",
+                                                       distance=tolerance)
+    precision = len(np.unique(det_idx)) / len(detected) if len(detected) else 1.0
+    recall = len(np.unique(exp_idx)) / len(expected) if len(expected) else 1.0
+    return {"expected": len(expected), "detected": len(detected),
+            "precision": round(precision, 4), "recall": round(recall, 4)}
+
+def run_case(n_segments, seed=0, engine="polygonize", min_radius=10, max_radius=100,
+             circularity_threshold=0.95, min_incoming=3, buffer_distance=10):
+    """
+    Generate one network, run the pipeline stages on it and return their
+    measurements, including the fine-grained stages recorded by profiling.
+    """
+    stages = {}
+    profiler = StageProfiler()
+    wall_start = time.perf_counter()
+
+    start = time.perf_counter()
+    roads, truth = generate_network(n_segments, seed=seed)
+    stages["generate"] = time.perf_counter() - start
+
+    with activate(profiler):
+        start = time.perf_counter()
+        roundabouts = detect_roundabouts(roads, min_radius=min_radius, max_radius=max_radius,
+                                         circularity_threshold=circularity_threshold,
+                                         min_incoming=min_incoming, engine=engine)
+        stages["detect_roundabouts"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            add_roundabout_attribute(roads, roundabouts, buffer_distance=buffer_distance)
+        stages["add_roundabout_attribute"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        classify_roads(roads, roundabouts, buffer_distance=buffer_distance)
+        stages["classify_roads"] = time.perf_counter() - start
+
+    return {
+        "target_segments": n_segments,
+        "segments": len(roads),
+        "planted_roundabouts": len(truth),
+        "wall_s": round(time.perf_counter() - wall_start, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages_s": {name: round(seconds, 3) for name, seconds in stages.items()},
+        "detect_stages": profiler.totals(),
+        **score_detections(roundabouts, truth, min_radius, max_radius, min_incoming),
+    }
+
+def _run_case_in_child(queue, kwargs):
+    queue.put(run_case(**kwargs))
+
+def run_benchmark(sizes=DEFAULT_SIZES, seed=0, engine="polygonize", **params):
+    """
+    Run run_case for each size in a fresh process, so peak RSS is measured
+    per size, and return a machine-readable report.
+    """
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for n_segments in sizes:
+        queue = context.Queue()
+        child = context.Process(target=_run_case_in_child,
+                                args=(queue, dict(n_segments=n_segments, seed=seed, engine=engine, **params)))
+        child.start()
+        result = queue.get()
+        child.join()
+        runs.append(result)
+        peak = "     n/a" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:8.1f}"
+        print(f"{result['segments']:>9} segments: {result['wall_s']:8.2f}s wall, "
+              f"{peak} MB peak, precision {result['precision']:.3f}, "
+              f"recall {result['recall']:.3f}")
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "shapely": shapely.__version__,
+            "geopandas": gpd.__version__,
+            "engine": engine,
+            "seed": seed,
+            "params": params,
+        },
+        "runs": runs,
+    }
+
+def run_crossover(n_segments=200_000, counts=DEFAULT_CROSSOVER_COUNTS, seed=0, buffer_distance=10, repeat=3):
+    """
+    Time add_roundabout_attribute's "union" and "index" methods on one
+    synthetic network for growing numbers of roundabouts (random subsets of
+    the detected ones), check that they agree and report where "index"
+    becomes faster.
+    """
+    roads, _ = generate_network(n_segments, seed=seed, roundabout_share=0.6)
+    detected = detect_roundabouts(roads, min_radius=10, max_radius=100, circularity_threshold=0.95)
+    rng = np.random.default_rng(seed)
+    rows = []
+    for count in counts:
+        if count > len(detected):
+            break
+        subset = detected.iloc[np.sort(rng.choice(len(detected), count, replace=False))]
+        timings, results = {}, {}
+        for method in ("union", "index"):
+            best = np.inf
+            for _ in range(repeat):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results[method] = add_roundabout_attribute(roads, subset, buffer_distance, method=method)
+                best = min(best, time.perf_counter() - start)
+            timings[method] = best
+        identical = bool((results["union"]['has_roundabout'] == results["index"]['has_roundabout']).all())
+        rows.append({"roundabouts": count, "union_s": round(timings["union"], 4),
+                     "index_s": round(timings["index"], 4), "identical": identical})
+        print(f"{count:>6} roundabouts: union {timings['union']:.3f}s, index {timings['index']:.3f}s"
+              f"{'' if identical else '  RESULTS DIFFER'}")
+
+    crossover = next((row["roundabouts"] for row in rows if row["index_s"] < row["union_s"]), None)
+    return {"segments": len(roads), "runs": rows, "crossover": crossover}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling benchmark for roundabout detection on synthetic networks.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Approximate segment counts to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=["polygonize", "graph"], default="polygonize")
+    parser.add_argument("--crossover", action="store_true",
+                        help="Instead, time add_roundabout_attribute's union and index methods by roundabout count")
+    parser.add_argument("--counts", type=int, nargs="+", default=list(DEFAULT_CROSSOVER_COUNTS),
+                        help="Roundabout counts for --crossover (network size: first --sizes value)")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON report path")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.crossover:
+        report = run_crossover(args.sizes[0], args.counts, seed=args.seed)
+        print(f"index is faster from {report['crossover']} roundabouts on")
+    else:
+        report = run_benchmark(args.sizes, seed=args.seed, engine=args.engine)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nBenchmark report saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import argparse
+import json
+import math
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+from algo import (OUTPUT_FORMATS, classify_road_geometries, detect_in_tiles, detect_roundabouts,
+                  print_roundabout_summary, safe_halo, write_layer)
+from road_cache import load_roads
+
+MANIFEST = "manifest.json"
+ROADS_STATE = "roads.parquet"
+ROUNDABOUTS_STATE = "roundabouts.parquet"
+
+def geometry_hashes(geoms):
+    """64-bit hash of each geometry's WKB, used to match features between drops."""
+    return pd.util.hash_array(shapely.to_wkb(np.asarray(geoms, dtype=object)))
+
+def canonical_order(roundabouts_gdf):
+    """
+    Sort roundabouts by centroid so a merged result has the same order as a
+    full run; the road classification depends on roundabout order.
+    """
+    centers = shapely.centroid(roundabouts_gdf.geometry.values)
+    order = np.lexsort((shapely.get_x(centers), shapely.get_y(centers)))
+    roundabouts = roundabouts_gdf.iloc[order].reset_index(drop=True)
+    roundabouts['center'] = centers[order]
+    return roundabouts
+
+def dirty_cells(changed_geoms, cell_size, halo):
+    """Grid cells (i, j) within halo of any changed geometry."""
+    cells = set()
+    for minx, miny, maxx, maxy in shapely.bounds(changed_geoms):
+        for i in range(int(np.floor((minx - halo) / cell_size)), int(np.floor((maxx + halo) / cell_size)) + 1):
+            for j in range(int(np.floor((miny - halo) / cell_size)), int(np.floor((maxy + halo) / cell_size)) + 1):
+                cells.add((i, j))
+    return sorted(cells)
+
+def _window_area(block, cell_size, halo):
+    """Area read to detect a (i0, j0, i1, j1) block of cells: the block plus its halo."""
+    return ((block[2] - block[0]) * cell_size + 2 * halo) * ((block[3] - block[1]) * cell_size + 2 * halo)
+
+def _bounding_block(blocks):
+    return (min(b[0] for b in blocks), min(b[1] for b in blocks),
+            max(b[2] for b in blocks), max(b[3] for b in blocks))
+
+def dirty_blocks(cells, cell_size, halo):
+    """
+    Group grid cells into disjoint rectangular blocks (i0, j0, i1, j1) of
+    cells i0 <= i < i1, j0 <= j < j1, each re-detected as one core.
+
+    The cells are first covered exactly by rectangles grown right, then up,
+    from the lowest uncovered cell. Two blocks whose halo windows overlap
+    are then replaced by their bounding block, together with every block it
+    overlaps, when that reads no more area (block plus halo) than they do
+    apart. A merged block may include unchanged cells; re-detecting those
+    gives the same roundabouts. Detection cost thus follows the changed
+    area rather than the number of dirty cells.
+    """
+    dirty = set(cells)
+    blocks = []
+    owner = {}  # cell -> index in blocks of the block covering it
+    for i, j in sorted(dirty, key=lambda cell: (cell[1], cell[0])):
+        if (i, j) in owner:
+            continue
+        i1 = i + 1
+        while (i1, j) in dirty and (i1, j) not in owner:
+            i1 += 1
+        j1 = j + 1
+        while all((k, j1) in dirty and (k, j1) not in owner for k in range(i, i1)):
+            j1 += 1
+        owner.update(((k, l), len(blocks)) for k in range(i, i1) for l in range(j, j1))
+        blocks.append((i, j, i1, j1))
+
+    if not blocks:
+        return []
+    # widespread changes: one block for everything is cheapest
+    everything = _bounding_block(blocks)
+    if _window_area(everything, cell_size, halo) <= sum(_window_area(b, cell_size, halo) for b in blocks):
+        return [everything]
+
+    def owners(box):
+        return {owner[k, l] for k in range(box[0], box[2]) for l in range(box[1], box[3]) if (k, l) in owner}
+
+    # blocks whose halo windows overlap are at most this many cells apart
+    near = math.ceil(2 * halo / cell_size)
+    pending = list(range(len(blocks)))
+    while pending:
+        index = pending.pop()
+        first = blocks[index]
+        if first is None:
+            continue
+        around = (first[0] - near, first[1] - near, first[2] + near, first[3] + near)
+        for other in sorted(owners(around) - {index}):
+            box = _bounding_block([first, blocks[other]])
+            group = owners(box)
+            while (grown := _bounding_block([blocks[g] for g in group])) != box:
+                box, group = grown, owners(grown)
+            if _window_area(box, cell_size, halo) <= sum(_window_area(blocks[g], cell_size, halo) for g in group):
+                for g in group:
+                    blocks[g] = None
+                owner.update(((k, l), len(blocks)) for k in range(box[0], box[2]) for l in range(box[1], box[3]))
+                pending.append(len(blocks))
+                blocks.append(box)
+                break
+    return sorted(block for block in blocks if block is not None)
+
+def _cell_of(points, cell_size):
+    return list(zip(np.floor(shapely.get_x(points) / cell_size).astype(int),
+                    np.floor(shapely.get_y(points) / cell_size).astype(int)))
+
+def _read_state(state_dir):
+    state_dir = Path(state_dir)
+    if not (state_dir / MANIFEST).exists():
+        return None, None, None
+    manifest = json.loads((state_dir / MANIFEST).read_text())
+    roads = gpd.read_parquet(state_dir / ROADS_STATE)
+    roundabouts = gpd.read_parquet(state_dir / ROUNDABOUTS_STATE)
+    roundabouts['center'] = shapely.centroid(roundabouts.geometry.values)
+    return manifest, roads, roundabouts
+
+def _write_state(state_dir, manifest, roads, roundabouts):
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    roads.to_parquet(state_dir / ROADS_STATE)
+    roundabouts.drop(columns='center').to_parquet(state_dir / ROUNDABOUTS_STATE)
+    (state_dir / MANIFEST).write_text(json.dumps(manifest, indent=2))
+
+def update_roundabouts(roads_gdf, state_dir, min_radius=10, max_radius=300, circularity_threshold=0.95,
+                       min_incoming=3, buffer_distance=10, near_distance=15, engine="polygonize",
+                       cell_size=2000, workers=1):
+    """
+    Bring the persisted roundabouts and road classification in state_dir up
+    to date with a new drop of the street layer.
+
+    Roads are matched to the previous run by geometry hash. Grid cells within
+    the tile halo (see algo.safe_halo) of an added or removed road are
+    re-detected, merged into larger blocks where that reads less (see
+    dirty_blocks); roundabouts whose centroid lies in those blocks are replaced.
+    Only new roads and roads within reach of a roundabout that appeared or
+    disappeared are re-classified; every other road keeps its previous
+    has_roundabout/roundabout_type. Without a compatible previous state
+    (none yet, or different parameters/CRS) everything is computed once.
+
+    Parameters:
+    - roads_gdf: New street layer in a projected CRS
+    - state_dir: Directory holding the persisted state
+    - min_radius, max_radius, circularity_threshold, min_incoming, engine: as in detect_roundabouts
+    - buffer_distance, near_distance: as in classify_road_geometries
+    - cell_size: Side of the change-tracking grid cells in CRS units
+    - workers: Worker processes used for the dirty cells
+
+    Returns:
+    - (roads, roundabouts, stats): the merged outputs and a dict describing the update
+    """
+    start = time.perf_counter()
+    detection_params = dict(min_radius=min_radius, max_radius=max_radius,
+                            circularity_threshold=circularity_threshold, min_incoming=min_incoming,
+                            engine=engine)
+    settings = dict(detection_params, buffer_distance=buffer_distance, near_distance=near_distance,
+                    cell_size=cell_size, crs=str(roads_gdf.crs))
+    halo = safe_halo(max_radius, circularity_threshold)
+
+    roads = roads_gdf[roads_gdf.is_valid].reset_index(drop=True)
+    road_geoms = roads.geometry.values
+    hashes = geometry_hashes(road_geoms)
+    manifest, previous_roads, previous_roundabouts = _read_state(state_dir)
+
+    if manifest is None or manifest["settings"] != settings:
+        roundabouts = canonical_order(detect_roundabouts(roads, **detection_params))
+        has_roundabout, roundabout_type = classify_road_geometries(
+            road_geoms, roundabouts.geometry.values, buffer_distance, near_distance)
+        stats = {"mode": "full", "roads": len(roads), "roundabouts": len(roundabouts)}
+    else:
+        old_hashes = previous_roads['geom_hash'].to_numpy()
+        added = ~np.isin(hashes, old_hashes)
+        removed = ~np.isin(old_hashes, hashes)
+        changed = np.concatenate([road_geoms[added], previous_roads.geometry.values[removed]])
+
+        # re-detect the cells a change can reach, in merged blocks, and replace what they owned
+        cells = dirty_cells(changed, cell_size, halo)
+        blocks = dirty_blocks(cells, cell_size, halo)
+        cores = [(i0 * cell_size, j0 * cell_size, i1 * cell_size, j1 * cell_size) for i0, j0, i1, j1 in blocks]
+        fresh = detect_in_tiles(roads, cores, halo, workers, **detection_params)
+        dirty = {(i, j) for i0, j0, i1, j1 in blocks for i in range(i0, i1) for j in range(j0, j1)}
+        stale = np.array([cell in dirty for cell in _cell_of(previous_roundabouts['center'].values, cell_size)],
+                         dtype=bool)
+        roundabouts = canonical_order(gpd.GeoDataFrame(
+            pd.concat([previous_roundabouts[~stale], fresh], ignore_index=True),
+            geometry='geometry', crs=roads.crs))
+
+        # carry the classification over, then redo it where a roundabout changed
+        previous = previous_roads.drop_duplicates('geom_hash').set_index('geom_hash')
+        has_roundabout = previous['has_roundabout'].reindex(hashes, fill_value=False).to_numpy(dtype=bool, copy=True)
+        roundabout_type = previous['roundabout_type'].reindex(hashes, fill_value=0).to_numpy(dtype=int, copy=True)
+
+        old_rb_hashes = geometry_hashes(previous_roundabouts.geometry.values)
+        new_rb_hashes = geometry_hashes(roundabouts.geometry.values)
+        changed_roundabouts = np.concatenate([
+            previous_roundabouts.geometry.values[~np.isin(old_rb_hashes, new_rb_hashes)],
+            roundabouts.geometry.values[~np.isin(new_rb_hashes, old_rb_hashes)],
+        ])
+        reach = shapely.buffer(changed_roundabouts, max(buffer_distance, near_distance))
+        _, near_change = STRtree(road_geoms).query(reach, predicate="intersects")
+        redo = added.copy()
+        redo[near_change] = True
+
+        redo_has, redo_type = classify_road_geometries(
+            road_geoms[redo], roundabouts.geometry.values, buffer_distance, near_distance)
+        has_roundabout[redo], roundabout_type[redo] = redo_has, redo_type
+        stats = {
+            "mode": "incremental",
+            "roads": len(roads),
+            "roads_added": int(added.sum()),
+            "roads_removed": int(removed.sum()),
+            "dirty_cells": len(cells),
+            "dirty_blocks": len(blocks),
+            "roundabouts": len(roundabouts),
+            "roundabouts_changed": len(changed_roundabouts),
+            "roads_reclassified": int(redo.sum()),
+        }
+
+    roads['has_roundabout'] = has_roundabout
+    roads['roundabout_type'] = roundabout_type
+    roads['geom_hash'] = hashes
+    _write_state(state_dir, {"settings": settings}, roads, roundabouts)
+
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    return roads.drop(columns='geom_hash'), roundabouts, stats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally update roundabout outputs for a new street drop.")
+    parser.add_argument("input", help="New street layer")
+    parser.add_argument("--state-dir", required=True, help="Directory with the state of the previous run")
+    parser.add_argument("-o", "--output-dir", default=None, help="Also write the three output layers here")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="gpkg")
+    parser.add_argument("--crs", default="EPSG:3059")
+    parser.add_argument("--cache-dir", default=None, help="GeoParquet cache for the projected roads")
+    parser.add_argument("--min-radius", type=float, default=10)
+    parser.add_argument("--max-radius", type=float, default=300)
+    parser.add_argument("--circularity-threshold", type=float, default=0.95)
+    parser.add_argument("--min-incoming", type=int, default=3)
+    parser.add_argument("--buffer-distance", type=float, default=10)
+    parser.add_argument("--engine", choices=["polygonize", "graph"], default="polygonize")
+    parser.add_argument("--cell-size", type=float, default=2000, help="Change-tracking grid cell size")
+    parser.add_argument("--workers", type=int, default=1)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    roads = load_roads(args.input, args.crs, cache_dir=args.cache_dir)
+    roads, roundabouts, stats = update_roundabouts(
+        roads, args.state_dir, min_radius=args.min_radius, max_radius=args.max_radius,
+        circularity_threshold=args.circularity_threshold, min_incoming=args.min_incoming,
+        buffer_distance=args.buffer_distance, engine=args.engine, cell_size=args.cell_size,
+        workers=args.workers)
+
+    print(json.dumps(stats, indent=2))
+    print_roundabout_summary(roads)
+
+    if args.output_dir:
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+        write_layer(roads.drop(columns='roundabout_type'), args.output_dir,
+                    "roads_with_roundabout_attribute", "roads_classified", args.format)
+        write_layer(roundabouts, args.output_dir, "detected_roundabouts", "roundabouts", args.format)
+        write_layer(roads.drop(columns='has_roundabout'), args.output_dir,
+                    "roads_detailed_roundabout_classification", "roads_detailed", args.format)
+
+if __name__ == "__main__":
+    main()
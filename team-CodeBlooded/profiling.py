@@ -0,0 +1,146 @@
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Profiler that stage() records into; None means instrumentation is a no-op
+_active = None
+
+def _rss_mb():
+    """Current resident set size in MB (Linux), or None where /proc is unavailable."""
+    if resource is None:
+        return None
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return round(pages * resource.getpagesize() / 2**20, 1)
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None without the resource module."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+class StageProfiler:
+    """
+    Collects wall time, CPU time, memory and item counts per pipeline stage.
+
+    Memory is reported as the process RSS before and after the stage and the
+    process peak RSS at its end. With trace_python_memory=True the peak of
+    Python-level allocations (including NumPy buffers, but not GEOS) inside
+    each stage is recorded as well, at some runtime cost.
+    """
+
+    def __init__(self, trace_python_memory=False):
+        self.stages = []
+        self.trace_python_memory = trace_python_memory
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None):
+        record = {"stage": name}
+        if self.trace_python_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        rss_before = _rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = round(time.perf_counter() - wall_start, 4)
+            record["cpu_s"] = round(time.process_time() - cpu_start, 4)
+            record["rss_before_mb"] = rss_before
+            record["rss_after_mb"] = _rss_mb()
+            record["peak_rss_mb"] = peak_rss_mb()
+            if self.trace_python_memory:
+                record["python_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            if items is not None and "items" not in record:
+                record["items"] = items
+            self.stages.append(record)
+
+    def add(self, records, **fields):
+        """Append stage records made elsewhere, e.g. in a worker process, with fields added."""
+        self.stages.extend(dict(record, **fields) for record in records)
+
+    def totals(self):
+        """Wall and CPU seconds summed per stage name."""
+        totals = {}
+        for record in self.stages:
+            entry = totals.setdefault(record["stage"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+            entry["calls"] += 1
+            entry["wall_s"] = round(entry["wall_s"] + record["wall_s"], 4)
+            entry["cpu_s"] = round(entry["cpu_s"] + record["cpu_s"], 4)
+        return totals
+
+    def report(self):
+        return {"stages": self.stages, "totals": self.totals()}
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+@contextlib.contextmanager
+def activate(profiler):
+    """Make `profiler` receive the stage() records of the code run inside the block."""
+    global _active
+    previous, _active = _active, profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+
+def active():
+    """The profiler stage() currently records into, or None."""
+    return _active
+
+def stage(name, items=None):
+    """
+    Time a pipeline stage on the active profiler, if any.
+
+    Used as `with stage("polygonize") as record:`; the caller may set
+    record["items"] to the number of items the stage produced.
+    """
+    if _active is None:
+        return contextlib.nullcontext({})
+    return _active.stage(name, items)
+
+@contextlib.contextmanager
+def call_profiler(cprofile_path=None, pyinstrument_path=None):
+    """
+    Optionally run the block under cProfile (pstats dump) and/or pyinstrument
+    (HTML report). pyinstrument is only imported when requested.
+    """
+    with contextlib.ExitStack() as stack:
+        if cprofile_path:
+            import cProfile
+
+            profile = cProfile.Profile()
+            profile.enable()
+            stack.callback(profile.dump_stats, cprofile_path)
+            stack.callback(profile.disable)
+        if pyinstrument_path:
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise SystemExit("pyinstrument is not installed: pip install pyinstrument")
+
+            sampler = Profiler()
+            sampler.start()
+
+            def _write_pyinstrument():
+                sampler.stop()
+                with open(pyinstrument_path, "w") as f:
+                    f.write(sampler.output_html())
+
+            stack.callback(_write_pyinstrument)
+        yield
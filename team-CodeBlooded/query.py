@@ -0,0 +1,241 @@
+import argparse
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+def read_layer(path):
+    """Read an output layer written by algo.write_layer (GeoPackage, GeoParquet or FlatGeobuf)."""
+    if Path(path).suffix.lower() == ".parquet":
+        return gpd.read_parquet(path)
+    return gpd.read_file(path)
+
+class RoundaboutIndex:
+    """
+    In-memory spatial index over detected roundabouts and classified roads.
+
+    Roundabouts are held in an STRtree, so point, bbox and nearest queries
+    touch only nearby polygons; road roundabout_type values are held in a
+    hash index keyed by road ID. Every query has a batch variant that takes
+    arrays and answers all of them with one bulk STRtree call.
+
+    Coordinates are in the CRS of the roundabout layer unless input_crs is
+    given (e.g. "EPSG:4326"), in which case query points and boxes are
+    transformed from it first. Distances are always in units of the layer CRS.
+    """
+
+    def __init__(self, roundabouts_gdf, roads_gdf=None, id_column="LINK_ID", input_crs=None):
+        self.roundabouts = roundabouts_gdf.reset_index(drop=True)
+        self.geoms = np.asarray(self.roundabouts.geometry.values, dtype=object)
+        self.centers = shapely.centroid(self.geoms)
+        self.tree = STRtree(self.geoms)
+
+        self.road_types = None
+        if roads_gdf is not None:
+            if 'roundabout_type' not in roads_gdf.columns:
+                raise ValueError("roads_gdf needs a 'roundabout_type' column (see classify_roads)")
+            if id_column not in roads_gdf.columns:
+                raise ValueError(f"roads_gdf has no ID column {id_column!r}")
+            self.road_types = roads_gdf.drop_duplicates(id_column).set_index(id_column)['roundabout_type']
+
+        self._transformer = None
+        if input_crs is not None:
+            from pyproj import Transformer
+
+            self._transformer = Transformer.from_crs(input_crs, self.roundabouts.crs, always_xy=True)
+
+    @classmethod
+    def from_files(cls, roundabouts_path, roads_path=None, id_column="LINK_ID", input_crs=None):
+        """Build the index from the files written by algo.run_pipeline."""
+        roundabouts = read_layer(roundabouts_path)
+        roads = read_layer(roads_path) if roads_path is not None else None
+        return cls(roundabouts.drop(columns='center', errors='ignore'), roads, id_column, input_crs)
+
+    def _points(self, xs, ys):
+        xs, ys = np.atleast_1d(np.asarray(xs, dtype=float)), np.atleast_1d(np.asarray(ys, dtype=float))
+        if self._transformer is not None:
+            xs, ys = self._transformer.transform(xs, ys)
+        return shapely.points(xs, ys)
+
+    def near_many(self, xs, ys, distance=0.0):
+        """
+        Roundabouts within distance of each point.
+
+        Returns:
+        - (point_idx, roundabout_idx): parallel arrays of matching pairs
+        """
+        points = self._points(xs, ys)
+        if distance > 0:
+            return self.tree.query(points, predicate="dwithin", distance=distance)
+        return self.tree.query(points, predicate="intersects")
+
+    def near(self, x, y, distance=0.0):
+        """Indices of the roundabouts within distance of (x, y)."""
+        return self.near_many(x, y, distance)[1]
+
+    def _boxes(self, bounds):
+        bounds = np.atleast_2d(np.asarray(bounds, dtype=float))
+        if self._transformer is not None:
+            # the layer-CRS box enclosing each input box, edges densified
+            bounds = np.array([self._transformer.transform_bounds(*box) for box in bounds])
+        return shapely.box(*bounds.T)
+
+    def in_bbox_many(self, bounds):
+        """
+        Roundabouts intersecting each (minx, miny, maxx, maxy) box. A box in
+        input_crs is replaced by the layer-CRS box enclosing it.
+
+        Returns:
+        - (box_idx, roundabout_idx): parallel arrays of matching pairs
+        """
+        return self.tree.query(self._boxes(bounds), predicate="intersects")
+
+    def in_bbox(self, minx, miny, maxx, maxy):
+        """Indices of the roundabouts intersecting the box."""
+        return self.in_bbox_many([(minx, miny, maxx, maxy)])[1]
+
+    def nearest_many(self, xs, ys, max_distance=None):
+        """
+        Nearest roundabout of each point.
+
+        Returns:
+        - (roundabout_idx, distance): arrays with one entry per point;
+          -1 and NaN where no roundabout is within max_distance
+        """
+        points = self._points(xs, ys)
+        nearest = np.full(len(points), -1, dtype=np.int64)
+        distance = np.full(len(points), np.nan)
+        (point_idx, roundabout_idx), dist = self.tree.query_nearest(
+            points, max_distance=max_distance, return_distance=True, all_matches=False)
+        nearest[point_idx] = roundabout_idx
+        distance[point_idx] = dist
+        return nearest, distance
+
+    def nearest(self, x, y, max_distance=None):
+        """(roundabout index, distance) of the roundabout nearest to (x, y), or (None, None)."""
+        nearest, distance = self.nearest_many(x, y, max_distance)
+        if nearest[0] < 0:
+            return None, None
+        return int(nearest[0]), float(distance[0])
+
+    def roundabout_types(self, road_ids):
+        """roundabout_type of each road ID, -1 for IDs not in the road layer."""
+        if self.road_types is None:
+            raise ValueError("the index was built without a road layer")
+        ids = pd.Index(np.atleast_1d(road_ids)).astype(self.road_types.index.dtype)
+        positions = self.road_types.index.get_indexer(ids)
+        types = self.road_types.to_numpy()[positions]
+        types[positions < 0] = -1
+        return types
+
+    def roundabout_type(self, road_id):
+        """roundabout_type of one road, or None if the ID is unknown."""
+        road_type = int(self.roundabout_types([road_id])[0])
+        return None if road_type < 0 else road_type
+
+    def records(self, roundabout_idx):
+        """Plain dicts describing the given roundabouts, for JSON responses."""
+        roundabout_idx = np.asarray(roundabout_idx, dtype=np.int64)
+        attributes = self.roundabouts.drop(columns='geometry').iloc[roundabout_idx]
+        return [
+            dict(id=int(i), x=float(shapely.get_x(self.centers[i])), y=float(shapely.get_y(self.centers[i])),
+                 **{key: value.item() if hasattr(value, 'item') else value for key, value in row.items()})
+            for i, row in zip(roundabout_idx, attributes.to_dict('records'))
+        ]
+
+def create_app(index):
+    """
+    FastAPI app answering roundabout queries from `index`. FastAPI is only
+    imported here, so the index itself works without it.
+    """
+    from fastapi import FastAPI, HTTPException
+    from pydantic import BaseModel
+
+    class PointsRequest(BaseModel):
+        x: list[float]
+        y: list[float]
+        distance: float = 0.0
+        max_distance: float | None = None
+
+    class RoadIdsRequest(BaseModel):
+        ids: list[int | str]
+
+    app = FastAPI(title="Roundabout query service")
+
+    @app.get("/roundabouts/near")
+    def near(x: float, y: float, distance: float = 0.0):
+        return index.records(index.near(x, y, distance))
+
+    @app.get("/roundabouts/bbox")
+    def in_bbox(minx: float, miny: float, maxx: float, maxy: float):
+        return index.records(index.in_bbox(minx, miny, maxx, maxy))
+
+    @app.get("/roundabouts/nearest")
+    def nearest(x: float, y: float, max_distance: float | None = None):
+        roundabout, distance = index.nearest(x, y, max_distance)
+        if roundabout is None:
+            raise HTTPException(status_code=404, detail="No roundabout within max_distance")
+        return dict(index.records([roundabout])[0], distance=distance)
+
+    @app.post("/roundabouts/near")
+    def near_batch(request: PointsRequest):
+        if len(request.x) != len(request.y):
+            raise HTTPException(status_code=422, detail="x and y must have the same length")
+        point_idx, roundabout_idx = index.near_many(request.x, request.y, request.distance)
+        near_any = np.zeros(len(request.x), dtype=bool)
+        near_any[point_idx] = True
+        return {"near": near_any.tolist()}
+
+    @app.post("/roundabouts/nearest")
+    def nearest_batch(request: PointsRequest):
+        if len(request.x) != len(request.y):
+            raise HTTPException(status_code=422, detail="x and y must have the same length")
+        roundabout_idx, distance = index.nearest_many(request.x, request.y, request.max_distance)
+        return {"roundabout": roundabout_idx.tolist(),
+                "distance": [None if np.isnan(d) else float(d) for d in distance]}
+
+    @app.get("/roads/{road_id}/roundabout_type")
+    def road_type(road_id: str):
+        try:
+            road_type = index.roundabout_type(road_id)
+        except ValueError as error:
+            raise HTTPException(status_code=422, detail=str(error))
+        if road_type is None:
+            raise HTTPException(status_code=404, detail=f"Unknown road {road_id}")
+        return {"id": road_id, "roundabout_type": road_type}
+
+    @app.post("/roads/roundabout_type")
+    def road_types(request: RoadIdsRequest):
+        try:
+            types = index.roundabout_types(request.ids)
+        except ValueError as error:
+            raise HTTPException(status_code=422, detail=str(error))
+        return {"roundabout_type": [None if t < 0 else int(t) for t in types]}
+
+    return app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve point, bbox, nearest and road-type queries over roundabout outputs.")
+    parser.add_argument("roundabouts", help="detected_roundabouts layer written by algo.py")
+    parser.add_argument("--roads", default=None, help="roads_detailed_roundabout_classification layer")
+    parser.add_argument("--id-column", default="LINK_ID", help="Road ID column used for lookups")
+    parser.add_argument("--input-crs", default=None, help="CRS of query coordinates (default: layer CRS)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    index = RoundaboutIndex.from_files(args.roundabouts, args.roads, args.id_column, args.input_crs)
+    print(f"Indexed {len(index.geoms)} roundabouts"
+          + (f" and {len(index.road_types)} roads" if index.road_types is not None else ""))
+
+    import uvicorn
+
+    uvicorn.run(create_app(index), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import geopandas as gpd
+import shapely
+
+from profiling import stage
+
+# Files that make up a shapefile dataset; a change to any of them invalidates the cache
+SHAPEFILE_SIDECARS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+def source_fingerprint(path, hash_contents=False):
+    """
+    Describe the current state of a source dataset.
+
+    Uses size and modification time of the file and its shapefile sidecars,
+    or a SHA-1 of their bytes when hash_contents is True.
+    """
+    path = Path(path)
+    members = [path.with_suffix(suffix) for suffix in SHAPEFILE_SIDECARS] if path.suffix.lower() == ".shp" else [path]
+    fingerprint = []
+    for member in members:
+        if not member.exists():
+            continue
+        if hash_contents:
+            digest = hashlib.sha1()
+            with open(member, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            fingerprint.append((member.name, digest.hexdigest()))
+        else:
+            stat = member.stat()
+            fingerprint.append((member.name, stat.st_size, stat.st_mtime_ns))
+    return fingerprint
+
+def cache_key(path, crs, columns=None, hash_contents=False, roi=None):
+    """Key of the cached projection of `path` into `crs` with the given columns and ROI."""
+    payload = {
+        "source": str(Path(path).resolve()),
+        "fingerprint": source_fingerprint(path, hash_contents),
+        "crs": str(crs),
+        "columns": sorted(columns) if columns is not None else None,
+        "roi": shapely.to_wkb(shapely.normalize(roi), hex=True) if roi is not None else None,
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+def region_of_interest(crs, bbox=None, roi_path=None, bbox_crs=None):
+    """
+    Build the region of interest in the projected CRS `crs`.
+
+    Parameters:
+    - crs: CRS the detection runs in
+    - bbox: (minx, miny, maxx, maxy) in bbox_crs
+    - roi_path: Vector file whose (unioned) polygons form the region
+    - bbox_crs: CRS of bbox (default: crs)
+
+    Returns:
+    - Shapely geometry in crs, or None when neither bbox nor roi_path is given
+    """
+    parts = []
+    if bbox is not None:
+        parts.append(gpd.GeoSeries([shapely.box(*bbox)], crs=bbox_crs or crs).to_crs(crs))
+    if roi_path is not None:
+        parts.append(gpd.read_file(roi_path).geometry.to_crs(crs))
+    if not parts:
+        return None
+    return shapely.intersection_all([shapely.union_all(part.values) for part in parts])
+
+def read_projected_roads(path, crs="EPSG:3059", columns=None, roi=None):
+    """
+    Read a street layer, keep the requested columns, project it and drop
+    invalid geometries.
+
+    With a region of interest (a geometry in crs) the spatial filter is
+    pushed down into the OGR reader, which uses the .sbn/.sbx (or .qix)
+    spatial index of a shapefile, so only features near the region are
+    parsed. A rectangle is passed as bbox, anything else as mask; both are
+    reprojected to the source CRS by geopandas. Roads that do not intersect
+    the region in crs are dropped after projection.
+    """
+    with stage("read") as record:
+        if roi is None:
+            roads = gpd.read_file(path, columns=columns)
+        elif shapely.equals(roi, shapely.envelope(roi)):
+            roads = gpd.read_file(path, columns=columns, bbox=gpd.GeoSeries([roi], crs=crs))
+        else:
+            roads = gpd.read_file(path, columns=columns, mask=gpd.GeoSeries([roi], crs=crs))
+        record["items"] = len(roads)
+    with stage("reproject", items=len(roads)):
+        roads = roads.to_crs(crs)
+    if roi is not None:
+        with stage("roi_filter") as record:
+            roads = roads[roads.intersects(roi)]
+            record["items"] = len(roads)
+    with stage("validity_filter") as record:
+        roads = roads[roads.is_valid].reset_index(drop=True)
+        record["items"] = len(roads)
+    return roads
+
+def load_roads(path, crs="EPSG:3059", cache_dir=None, columns=None, hash_contents=False, roi=None):
+    """
+    Load the projected, validity-filtered street layer, going through a
+    GeoParquet cache when cache_dir is given.
+
+    A cold run reads the source with the OGR driver, reprojects it and stores
+    the result as GeoParquet under cache_dir. Warm runs with an unchanged
+    source, CRS, column list and region memory-map that file instead,
+    skipping both parsing and reprojection.
+
+    Parameters:
+    - path: Source street layer (e.g. data/raw/Streets.shp)
+    - crs: Target projected CRS
+    - cache_dir: Cache directory, or None to always read the source
+    - columns: Attribute columns to keep (None = all)
+    - hash_contents: Key the cache on file contents instead of size/mtime
+    - roi: Region of interest in crs (see region_of_interest); None = whole layer
+
+    Returns:
+    - GeoDataFrame of projected roads
+    """
+    if cache_dir is None:
+        return read_projected_roads(path, crs, columns, roi)
+
+    cache_dir = Path(cache_dir)
+    cached = cache_dir / f"{Path(path).stem}-{cache_key(path, crs, columns, hash_contents, roi)}.parquet"
+    if cached.exists():
+        with stage("read_cache") as record:
+            roads = gpd.read_parquet(cached, memory_map=True)
+            record["items"] = len(roads)
+        return roads
+
+    roads = read_projected_roads(path, crs, columns, roi)
+    with stage("write_cache", items=len(roads)):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        partial = cached.with_suffix(f".{os.getpid()}.tmp")
+        roads.to_parquet(partial)
+        os.replace(partial, cached)
+    return roads
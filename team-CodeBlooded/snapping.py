@@ -0,0 +1,140 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely import STRtree
+
+from algo import OUTPUT_FORMATS, classify_roads, detect_roundabouts, write_layer
+from road_cache import load_roads
+
+# Values of the roundabout columns for points with no road within max_distance
+UNMATCHED = {"has_roundabout": False, "roundabout_type": 0}
+
+# Road tree of a pool worker, built once by _init_worker
+_tree = None
+
+def _init_worker(road_geoms):
+    global _tree
+    _tree = STRtree(road_geoms)
+
+def _nearest_roads(tree, xy, max_distance):
+    """Nearest road of each point in the (n, 2) array xy: (road_idx, distance), -1/NaN if none."""
+    road_idx = np.full(len(xy), -1, dtype=np.int64)
+    distance = np.full(len(xy), np.nan)
+    located = np.flatnonzero(~np.isnan(xy).any(axis=1))
+    (point_idx, found), dist = tree.query_nearest(shapely.points(xy[located]), max_distance=max_distance,
+                                                  return_distance=True, all_matches=False)
+    point_idx = located[point_idx]
+    road_idx[point_idx] = found
+    distance[point_idx] = dist
+    return road_idx, distance
+
+def _snap_chunk(task):
+    xy, max_distance = task
+    return _nearest_roads(_tree, xy, max_distance)
+
+def snap_points(points_gdf, roads_gdf, max_distance=50, chunk_size=50_000, workers=None,
+                columns=("has_roundabout", "roundabout_type")):
+    """
+    Tag each point with its nearest road segment and that segment's roundabout attributes.
+
+    The roads go into one STRtree and every chunk of points is answered by a
+    single bulk query_nearest call limited to max_distance. With more than
+    one worker the chunks run in a process pool whose workers build the tree
+    once, at start-up.
+
+    Parameters:
+    - points_gdf: GeoDataFrame of points (reprojected to the road CRS if needed)
+    - roads_gdf: Classified roads, e.g. the output of classify_roads
+    - max_distance: Search radius in road CRS units; points further away stay unmatched
+    - chunk_size: Points per bulk query / pool task
+    - workers: Worker processes (None = CPU count, 1 = in this process)
+    - columns: Road columns copied onto the points
+
+    Returns:
+    - Copy of points_gdf with 'road_index' (-1 when unmatched), 'snap_distance'
+      (NaN when unmatched) and the requested road columns (see UNMATCHED for
+      unmatched points; other columns are missing there)
+    """
+    points = points_gdf.to_crs(roads_gdf.crs) if points_gdf.crs != roads_gdf.crs else points_gdf.copy()
+    road_geoms = np.asarray(roads_gdf.geometry.values, dtype=object)
+
+    # non-point geometries (e.g. multipoints) are snapped by their centroid; empty ones stay unmatched
+    centers = shapely.centroid(np.asarray(points.geometry.values, dtype=object))
+    centers[shapely.is_empty(centers)] = None
+    xy = np.c_[shapely.get_x(centers), shapely.get_y(centers)]
+    chunks = [(xy[start:start + chunk_size], max_distance) for start in range(0, len(xy), chunk_size)]
+
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers <= 1:
+        tree = STRtree(road_geoms)
+        results = [_nearest_roads(tree, chunk, max_distance) for chunk, _ in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(road_geoms,)) as pool:
+            results = list(pool.map(_snap_chunk, chunks))
+
+    road_idx = np.concatenate([r for r, _ in results]) if results else np.empty(0, dtype=np.int64)
+    distance = np.concatenate([d for _, d in results]) if results else np.empty(0)
+
+    points['road_index'] = road_idx
+    points['snap_distance'] = distance
+    for column in columns:
+        source = roads_gdf[column].reset_index(drop=True)
+        if column in UNMATCHED:
+            values = source.reindex(road_idx, fill_value=UNMATCHED[column])
+        else:
+            # other columns (road IDs) become missing; integer IDs stay integers
+            values = source.astype("Int64" if source.dtype.kind in "iu" else source.dtype).reindex(road_idx)
+        points[column] = values.array
+    return points
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Snap points to their nearest street and copy its roundabout attributes.")
+    parser.add_argument("points", help="Point layer, e.g. data/raw/Singapore_Prime_LAT.shp")
+    parser.add_argument("--streets", default="data/raw/Streets.shp", help="Street layer to detect roundabouts in")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="gpkg")
+    parser.add_argument("--crs", default="EPSG:3059", help="Projected CRS used for detection and snapping")
+    parser.add_argument("--cache-dir", default=None, help="GeoParquet cache for the projected roads")
+    parser.add_argument("--id-column", default="LINK_ID", help="Road ID column copied onto the points")
+    parser.add_argument("--max-distance", type=float, default=50, help="Snapping radius in CRS units")
+    parser.add_argument("--chunk-size", type=int, default=50_000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--min-radius", type=float, default=10)
+    parser.add_argument("--max-radius", type=float, default=300)
+    parser.add_argument("--circularity-threshold", type=float, default=0.95)
+    parser.add_argument("--min-incoming", type=int, default=3)
+    parser.add_argument("--buffer-distance", type=float, default=10)
+    parser.add_argument("--engine", choices=["polygonize", "graph"], default="polygonize")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    roads = load_roads(args.streets, args.crs, cache_dir=args.cache_dir)
+    roundabouts = detect_roundabouts(roads, min_radius=args.min_radius, max_radius=args.max_radius,
+                                     circularity_threshold=args.circularity_threshold,
+                                     min_incoming=args.min_incoming, engine=args.engine)
+    roads = classify_roads(roads, roundabouts, buffer_distance=args.buffer_distance)
+
+    start = time.perf_counter()
+    columns = ("has_roundabout", "roundabout_type")
+    if args.id_column in roads.columns:
+        columns = (args.id_column,) + columns
+    points = snap_points(gpd.read_file(args.points), roads, max_distance=args.max_distance,
+                         chunk_size=args.chunk_size, workers=args.workers, columns=columns)
+    matched = points['road_index'] >= 0
+    print(f"Snapped {int(matched.sum())} of {len(points)} points in {time.perf_counter() - start:.2f}s "
+          f"({int(points.loc[matched, 'has_roundabout'].sum())} on roads with a roundabout)")
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    path = write_layer(points, args.output_dir, f"{Path(args.points).stem}_snapped", "points_snapped", args.format)
+    print(f"Saved to {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import itertools
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+from algo import candidate_mask, count_incoming_roads, face_metrics, find_faces, max_face_perimeter
+from road_cache import load_roads
+
+SWEEP_PARAMETERS = ("min_radius", "max_radius", "circularity_threshold", "min_incoming", "buffer_distance")
+
+def sweep_roundabouts(roads_gdf, min_radius=(10,), max_radius=(50,), circularity_threshold=(1,),
+                      min_incoming=(3,), buffer_distance=(5,), engine="polygonize"):
+    """
+    Evaluate detect_roundabouts and add_roundabout_attribute over a grid of
+    thresholds while doing the expensive geometry work only once.
+
+    Faces are found, measured and given incoming-road counts a single time,
+    for the loosest combination of the grid. Road/face contacts are computed
+    once for the widest buffer_distance. Every combination is then a set of
+    NumPy masks over those arrays.
+
+    Parameters:
+    - roads_gdf: GeoDataFrame of roads in a projected CRS
+    - min_radius, max_radius, circularity_threshold, min_incoming, buffer_distance:
+      sequences of values to combine
+    - engine: Face engine, as in detect_roundabouts
+
+    Returns:
+    - (summary, detections, faces): summary has one row per combination with
+      the number of roundabouts and of streets marked has_roundabout;
+      detections is the tidy (combination, face_id) table of roundabouts
+      found; faces is a GeoDataFrame of the candidate faces with their
+      metrics and incoming_streets, indexed by face_id
+    """
+    roads_gdf = roads_gdf[roads_gdf.is_valid]
+    road_geoms = roads_gdf.geometry.values
+
+    # loosest filter of the grid, so every combination selects from these faces
+    all_faces = find_faces(road_geoms, engine,
+                           max_face_perimeter(max(max_radius), min(circularity_threshold)))
+    radius, circularity, area = face_metrics(all_faces)
+    loose = candidate_mask(radius, circularity, area, min(min_radius), max(max_radius),
+                           min(circularity_threshold))
+    faces = gpd.GeoDataFrame({
+        'geometry': all_faces[loose],
+        'radius': radius[loose],
+        'circularity': circularity[loose],
+        'area': area[loose],
+        'incoming_streets': count_incoming_roads(all_faces[loose], road_geoms),
+    }, geometry='geometry', crs=roads_gdf.crs)
+    faces.index.name = 'face_id'
+
+    # road/face contacts for the widest buffer, then the exact test per buffer distance
+    buffers = {d: shapely.buffer(faces.geometry.values, d) for d in buffer_distance}
+    road_idx, face_idx = STRtree(buffers[max(buffer_distance)]).query(road_geoms, predicate="intersects")
+    contacts = {d: shapely.intersects(road_geoms[road_idx], buffers[d][face_idx]) for d in buffer_distance}
+
+    combinations = pd.DataFrame(list(itertools.product(min_radius, max_radius, circularity_threshold,
+                                                       min_incoming, buffer_distance)),
+                                columns=list(SWEEP_PARAMETERS))
+    combinations.index.name = 'combination'
+
+    # one row per combination, one column per candidate face
+    c = {name: combinations[name].to_numpy()[:, None] for name in SWEEP_PARAMETERS}
+    selected = (candidate_mask(faces['radius'].to_numpy(), faces['circularity'].to_numpy(),
+                               faces['area'].to_numpy(), c['min_radius'], c['max_radius'],
+                               c['circularity_threshold']) &
+                (faces['incoming_streets'].to_numpy() >= c['min_incoming']))
+
+    streets = np.zeros(len(combinations), dtype=int)
+    for i, d in enumerate(combinations['buffer_distance']):
+        touching = contacts[d] & selected[i, face_idx]
+        streets[i] = len(np.unique(road_idx[touching]))
+
+    summary = combinations.assign(roundabouts=selected.sum(axis=1), streets_with_roundabout=streets)
+    combo, face = np.nonzero(selected)
+    detections = pd.DataFrame({'combination': combo, 'face_id': faces.index.to_numpy()[face]})
+    return summary, detections, faces
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep roundabout detection thresholds over one polygonize run.")
+    parser.add_argument("input", help="Street layer to sweep")
+    parser.add_argument("-o", "--output", default="roundabout_sweep.csv", help="CSV file for the summary table")
+    parser.add_argument("--crs", default="EPSG:3059")
+    parser.add_argument("--cache-dir", default=None, help="GeoParquet cache for the projected roads")
+    parser.add_argument("--engine", choices=["polygonize", "graph"], default="polygonize")
+    parser.add_argument("--min-radius", type=float, nargs="+", default=[10])
+    parser.add_argument("--max-radius", type=float, nargs="+", default=[300])
+    parser.add_argument("--circularity-threshold", type=float, nargs="+", default=[0.95])
+    parser.add_argument("--min-incoming", type=int, nargs="+", default=[3])
+    parser.add_argument("--buffer-distance", type=float, nargs="+", default=[10])
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    roads = load_roads(args.input, args.crs, cache_dir=args.cache_dir)
+    summary, _, _ = sweep_roundabouts(roads, engine=args.engine,
+                                      **{name: getattr(args, name) for name in SWEEP_PARAMETERS})
+    summary.to_csv(args.output)
+    print(summary.to_string())
+    print(f"\nSweep of {len(summary)} combinations saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
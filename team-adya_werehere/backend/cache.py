@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Protocol
+
+from models import SearchRequest, SearchResponse
+
+
+class CacheBackend(Protocol):
+    """Shared cache (e.g. Redis) behind the in-process LRU; values are JSON bytes."""
+
+    async def get(self, key: str) -> bytes | None: ...
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None: ...
+
+
+class LocalCacheBackend:
+    """In-process stand-in for a shared CacheBackend, for development and tests."""
+
+    def __init__(self):
+        self._entries: dict[str, tuple[float, bytes]] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+
+
+def canonical_request(request: SearchRequest) -> str:
+    """
+    Canonical JSON form of a search request: requests that Elasticsearch
+    answers identically map to the same string. Text is lowercased and
+    whitespace-collapsed (every searched field is analyzed or normalized to
+    lowercase), cuisine and facet lists are sorted and deduplicated, and
+    only the dietary preferences that add a filter (those set to true) are
+    kept.
+    """
+    fields = request.model_dump(mode="json")
+    for name in ("query", "location"):
+        # an empty string adds no clause, like None
+        value = fields.get(name)
+        fields[name] = " ".join(value.split()).lower() if value else None
+    for name in ("cuisine_types", "facets"):
+        if fields.get(name) is not None:
+            fields[name] = sorted(set(fields[name])) or None
+    if request.dietary_preferences is not None:
+        preferences = request.dietary_preferences.model_dump(exclude_unset=True)
+        enabled = sorted(name for name, value in preferences.items() if value)
+        fields["dietary_preferences"] = enabled or None
+    return json.dumps(fields, sort_keys=True, separators=(",", ":"))
+
+
+class SearchCache:
+    """
+    Cache of SearchResponse objects keyed by canonical request and index version.
+
+    Lookups go to an in-process LRU of max_entries responses first, then to
+    the optional shared backend. Entries expire after ttl seconds. The index
+    version (the index the search alias points at and when it was last
+    loaded) is part of every key and is re-read from version_source at most
+    every version_check_interval seconds, so any ingestion, full or
+    incremental, invalidates everything cached before it.
+    """
+
+    def __init__(
+        self,
+        version_source: Callable[[], Awaitable[str]],
+        max_entries: int = 1024,
+        ttl: float = 300,
+        backend: CacheBackend | None = None,
+        version_check_interval: float = 5,
+    ):
+        self.version_source = version_source
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.version_check_interval = version_check_interval
+
+        self._entries: OrderedDict[str, tuple[float, SearchResponse]] = OrderedDict()
+        self._version: str | None = None
+        self._version_checked = 0.0
+        self._stats = {
+            "hits": 0,
+            "backend_hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+            "hit_seconds": 0.0,
+            "miss_seconds": 0.0,
+        }
+
+    @classmethod
+    def from_env(
+        cls,
+        version_source: Callable[[], Awaitable[str]],
+        backend: CacheBackend | None = None,
+    ) -> "SearchCache":
+        """
+        Cache configured by SEARCH_CACHE_SIZE (entries, default 1024; 0
+        disables caching), SEARCH_CACHE_TTL (seconds, default 300) and
+        SEARCH_CACHE_VERSION_CHECK (seconds, default 5).
+        """
+        return cls(
+            version_source,
+            backend=backend,
+            max_entries=int(os.environ.get("SEARCH_CACHE_SIZE", 1024)),
+            ttl=float(os.environ.get("SEARCH_CACHE_TTL", 300)),
+            version_check_interval=float(
+                os.environ.get("SEARCH_CACHE_VERSION_CHECK", 5)
+            ),
+        )
+
+    async def _current_version(self) -> str:
+        now = time.monotonic()
+        fresh = now - self._version_checked < self.version_check_interval
+        if self._version is not None and fresh:
+            return self._version
+
+        version = await self.version_source()
+        self._version_checked = now
+        if version != self._version:
+            if self._version is not None:
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            self._version = version
+        return version
+
+    async def get_or_compute(
+        self,
+        request: SearchRequest,
+        compute: Callable[[], Awaitable[SearchResponse]],
+    ) -> SearchResponse:
+        """Cached response for request; computed and stored on a miss."""
+        if self.max_entries <= 0:
+            return await compute()
+
+        start = time.perf_counter()
+        version = await self._current_version()
+        digest = hashlib.sha1(canonical_request(request).encode("utf-8")).hexdigest()
+        key = f"search:{version}:{digest}"
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            self._stats["hit_seconds"] += time.perf_counter() - start
+            return entry[1]
+
+        response = None
+        if self.backend is not None:
+            cached = await self.backend.get(key)
+            if cached is not None:
+                response = SearchResponse.model_validate_json(cached)
+                self._stats["backend_hits"] += 1
+
+        if response is None:
+            response = await compute()
+            self._stats["misses"] += 1
+            self._stats["miss_seconds"] += time.perf_counter() - start
+            if self.backend is not None:
+                value = response.model_dump_json().encode("utf-8")
+                await self.backend.set(key, value, self.ttl)
+
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return response
+
+    def stats(self) -> dict:
+        hits, misses = self._stats["hits"], self._stats["misses"]
+        lookups = hits + self._stats["backend_hits"] + misses
+        hit_seconds = self._stats["hit_seconds"]
+        miss_seconds = self._stats["miss_seconds"]
+        return {
+            "version": self._version,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": hits,
+            "backend_hits": self._stats["backend_hits"],
+            "misses": misses,
+            "invalidations": self._stats["invalidations"],
+            "hit_rate": (lookups - misses) / lookups if lookups else 0.0,
+            "mean_hit_ms": 1000 * hit_seconds / hits if hits else None,
+            "mean_miss_ms": 1000 * miss_seconds / misses if misses else None,
+        }
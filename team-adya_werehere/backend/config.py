@@ -1 +1,2 @@
+# Alias the API searches; scripts/ingest_data.py points it at the newest restaurants_v{n} index
 RESTAURANT_INDEX_NAME = "restaurants"
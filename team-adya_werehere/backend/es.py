@@ -2,7 +2,12 @@ import os
 from functools import lru_cache
 
 from dotenv import load_dotenv
-from elasticsearch import AuthenticationException, ConnectionError, Elasticsearch
+from elasticsearch import (
+    AsyncElasticsearch,
+    AuthenticationException,
+    ConnectionError,
+    Elasticsearch,
+)
 from elasticsearch.exceptions import ConnectionTimeout
 
 load_dotenv()
@@ -29,3 +34,26 @@ def get_es_client() -> Elasticsearch:
         return client
     except (ConnectionError, AuthenticationException, ConnectionTimeout) as e:
         raise ValueError(f"Failed to connect to Elasticsearch: {e}")
+
+
+def create_async_es_client() -> AsyncElasticsearch:
+    """
+    Returns a new AsyncElasticsearch client for the API server.
+
+    The client keeps a pool of up to ES_CONNECTIONS_PER_NODE keep-alive
+    connections per node (default 10), so that many requests can wait on
+    Elasticsearch concurrently without blocking the event loop, and gives
+    up on a request after ES_REQUEST_TIMEOUT seconds (default 10).
+    The caller owns the client and must close it.
+    """
+    try:
+        return AsyncElasticsearch(
+            os.environ.get("ES_HOST"),
+            api_key=os.environ.get("ES_API_KEY"),
+            connections_per_node=int(os.environ.get("ES_CONNECTIONS_PER_NODE", 10)),
+            request_timeout=float(os.environ.get("ES_REQUEST_TIMEOUT", 10)),
+            retry_on_timeout=True,
+            max_retries=3,
+        )
+    except (ConnectionError, AuthenticationException, ConnectionTimeout) as e:
+        raise ValueError(f"Failed to connect to Elasticsearch: {e}")
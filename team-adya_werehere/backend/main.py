@@ -1,11 +1,97 @@
-from fastapi import FastAPI, HTTPException, status
+import base64
+import json
+import math
+from collections.abc import Collection
+from contextlib import asynccontextmanager
+
+from elasticsearch import AsyncElasticsearch, NotFoundError
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 
+from cache import SearchCache
 from config import RESTAURANT_INDEX_NAME
-from es import get_es_client
-from models import Restaurant, SearchRequest, SearchResponse
+from es import create_async_es_client
+from models import (
+    DietaryOptions,
+    FacetCount,
+    GeoPoint,
+    Restaurant,
+    RouteSearchRequest,
+    RouteSearchResponse,
+    SearchRequest,
+    SearchResponse,
+    Suggestion,
+    SuggestResponse,
+)
+from route import RouteCorridor, decode_flexible_polyline
+
+SEARCH_SORT = [
+    {"rating": {"order": "desc"}},
+    {"quality": {"order": "desc"}},
+    {"name.keyword": {"order": "asc"}},  # For consistent ordering
+]
+# Matches are counted up to this many unless the request asks for exact_total
+TOTAL_HITS_CAP = 10_000
+# How long a search cursor (point in time) stays usable between pages
+CURSOR_KEEP_ALIVE = "2m"
+# Route search candidates fetched per request, as a multiple of max_results:
+# the query rectangles reach past the corridor, so some hits are dropped
+ROUTE_OVERFETCH = 2
+# Route search stops after examining this many candidates
+ROUTE_CANDIDATES_CAP = 10_000
+# Aggregations behind SearchRequest.facets
+FACET_AGGREGATIONS = {
+    "cuisines": {"terms": {"field": "cuisines.keyword", "size": 50}},
+    "hygiene": {"terms": {"field": "hygiene", "size": 10}},
+    "dietary": {
+        "filters": {
+            "filters": {
+                pref: {"term": {f"dietary_options.{pref}": True}}
+                for pref in DietaryOptions.model_fields
+            }
+        }
+    },
+    # at least this rating, like SearchRequest.min_rating
+    "rating": {
+        "range": {
+            "field": "rating",
+            "ranges": [{"key": f"{r}+", "from": r} for r in (4.5, 4.0, 3.5, 3.0)],
+        }
+    },
+}
+# Completion inputs stored with each restaurant, left out of search hits
+SOURCE_EXCLUDES = ["*_suggest"]
+# Completion fields behind /api/v1/suggest, in order of precedence on ties
+SUGGESTION_TYPES = ("cuisine", "name", "location")
+
+
+async def _index_version(es: AsyncElasticsearch) -> str:
+    """
+    Index behind the search alias and when it was last loaded: a full
+    ingestion switches the index, an incremental one updates the
+    loaded_at mapping metadata.
+    """
+    try:
+        mappings = await es.indices.get_mapping(index=RESTAURANT_INDEX_NAME)
+    except NotFoundError:
+        return RESTAURANT_INDEX_NAME
+    return ",".join(
+        f"{index}@{mapping['mappings'].get('_meta', {}).get('loaded_at', '')}"
+        for index, mapping in sorted(mappings.items())
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.es = create_async_es_client()
+    app.state.search_cache = SearchCache.from_env(lambda: _index_version(app.state.es))
+    try:
+        yield
+    finally:
+        await app.state.es.close()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -14,7 +100,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-es = get_es_client()
+
+def get_es(http_request: Request) -> AsyncElasticsearch | None:
+    return getattr(http_request.app.state, "es", None)
+
+
+def get_search_cache(http_request: Request) -> SearchCache:
+    return http_request.app.state.search_cache
 
 
 @app.get("/api/v1/hello")
@@ -23,13 +115,253 @@ def read_root():
 
 
 @app.post("/api/v1/search")
-async def search(request: SearchRequest) -> SearchResponse:
+async def search(
+    request: SearchRequest,
+    es: AsyncElasticsearch | None = Depends(get_es),
+    cache: SearchCache = Depends(get_search_cache),
+) -> SearchResponse:
     if not es:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Elasticsearch is not available",
         )
 
+    if request.with_cursor or request.cursor:
+        # a cursor is tied to a point in time that expires, so never cache it
+        return await _search(es, request)
+    return await cache.get_or_compute(request, lambda: _search(es, request))
+
+
+@app.post("/api/v1/search/route")
+async def search_route(
+    request: RouteSearchRequest, es: AsyncElasticsearch | None = Depends(get_es)
+) -> RouteSearchResponse:
+    """
+    Restaurants within width_m of a route, ordered by their position along it.
+
+    The route is simplified and buffered once and searched with one query:
+    a geo_shape rectangle per simplified segment on the indexed geo_location
+    point. The best rated candidates are located exactly on the route, and
+    those outside the corridor dropped; more are fetched with search_after
+    until max_results remain, which usually takes a single request.
+    """
+    if not es:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Elasticsearch is not available",
+        )
+
+    if request.points is not None:
+        points = [(point.lat, point.lng) for point in request.points]
+    else:
+        # the model requires either points or a polyline
+        assert request.polyline is not None
+        sections = request.polyline
+        if isinstance(sections, str):
+            sections = [sections]
+        try:
+            points = []
+            for section in sections:
+                points.extend(decode_flexible_polyline(section))
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if not points:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="The route has no points"
+        )
+
+    corridor = RouteCorridor(points, request.width_m)
+    shapes = [
+        {
+            "geo_shape": {
+                "geo_location": {
+                    "shape": {"type": "polygon", "coordinates": [ring]},
+                    "relation": "intersects",
+                }
+            }
+        }
+        for ring in corridor.polygons()
+    ]
+    filters = request.filters or SearchRequest.model_validate({})
+    query = {
+        "bool": {
+            "must": [_build_query(filters)],
+            "filter": [{"bool": {"should": shapes, "minimum_should_match": 1}}],
+        }
+    }
+
+    # one more than max_results tells whether the corridor holds more
+    wanted = request.max_results + 1
+    size = ROUTE_OVERFETCH * wanted
+    located, examined, params = [], 0, {}
+    while True:
+        response = await es.search(
+            index=RESTAURANT_INDEX_NAME,
+            query=query,
+            size=size,
+            sort=SEARCH_SORT,
+            source_excludes=SOURCE_EXCLUDES,
+            timeout="30s",
+            track_total_hits=False,
+            **params,
+        )
+        hits = response["hits"]["hits"]
+        examined += len(hits)
+        for hit in hits:
+            point = hit["_source"].get("geo_location")
+            position = point and corridor.locate(point["lat"], point["lon"])
+            if position:
+                restaurant = Restaurant(**hit["_source"])
+                restaurant.route_position_km = position[0] / 1000
+                restaurant.route_distance_m = position[1]
+                located.append(restaurant)
+        # past the cap, more restaurants may be in the corridor but are not looked for
+        truncated = len(located) >= wanted or (
+            len(hits) == size and examined >= ROUTE_CANDIDATES_CAP
+        )
+        if truncated or len(hits) < size:
+            break
+        params = {"search_after": hits[-1]["sort"]}
+
+    # hits arrive best rated first
+    results = located[: request.max_results]
+    results.sort(key=lambda restaurant: restaurant.route_position_km)
+
+    return RouteSearchResponse(
+        route_length_km=corridor.length_m / 1000,
+        truncated=truncated,
+        results=results,
+    )
+
+
+@app.get("/api/v1/suggest")
+async def suggest(
+    q: str = Query(min_length=1, max_length=100),
+    size: int = Query(default=8, gt=0, le=20),
+    es: AsyncElasticsearch | None = Depends(get_es),
+) -> SuggestResponse:
+    """
+    Restaurant names, cuisines and locations starting with q, best rated
+    first: one request to the in-memory completion suggesters, cheap
+    enough to send on every keystroke.
+    """
+    if not es:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Elasticsearch is not available",
+        )
+
+    suggesters = {
+        kind: {
+            "prefix": q,
+            "completion": {
+                "field": f"{kind}_suggest",
+                "size": size,
+                "skip_duplicates": True,
+            },
+        }
+        for kind in SUGGESTION_TYPES
+    }
+    response = await es.search(
+        index=RESTAURANT_INDEX_NAME,
+        suggest=suggesters,
+        source_includes=["name"],
+        size=0,
+    )
+
+    options = []
+    for kind in SUGGESTION_TYPES:
+        for entry in response.get("suggest", {}).get(kind, []):
+            for option in entry["options"]:
+                # a name can match on a later word: suggest the whole name;
+                # cuisines and localities are suggested as matched
+                text = option["_source"]["name"] if kind == "name" else option["text"]
+                options.append((option["_score"], Suggestion(text=text, type=kind)))
+
+    options.sort(key=lambda option: option[0], reverse=True)
+    suggestions, seen = [], set()
+    for _, suggestion in options:
+        key = (suggestion.type, suggestion.text.lower())
+        if key not in seen:
+            seen.add(key)
+            suggestions.append(suggestion)
+    return SuggestResponse(suggestions=suggestions[:size])
+
+
+@app.get("/api/v1/search/cache")
+def search_cache_stats(cache: SearchCache = Depends(get_search_cache)) -> dict:
+    return cache.stats()
+
+
+def _geo_point(point: GeoPoint) -> dict:
+    return {"lat": point.lat, "lon": point.lng}
+
+
+def _sort(request: SearchRequest) -> list[dict]:
+    """Sort of the search: nearest first when a center is given."""
+    if not request.near:
+        return SEARCH_SORT
+    distance = {
+        "_geo_distance": {
+            "geo_location": _geo_point(request.near.center),
+            "order": "asc",
+            "unit": "km",
+        }
+    }
+    return [distance] + SEARCH_SORT
+
+
+def _facet_filters(request: SearchRequest) -> dict[str, list[dict]]:
+    """Filters of request on the fields that have facets, by facet name."""
+    filters = {facet: [] for facet in FACET_AGGREGATIONS}
+
+    if request.cuisine_types:
+        # analyzed cuisine words, or exact values such as the cuisines facet's
+        filters["cuisines"].append(
+            {
+                "bool": {
+                    "should": [
+                        {"terms": {"cuisines": request.cuisine_types}},
+                        {"terms": {"cuisines.keyword": request.cuisine_types}},
+                    ],
+                    "minimum_should_match": 1,
+                }
+            }
+        )
+
+    if request.min_rating is not None:
+        filters["rating"].append({"range": {"rating": {"gte": request.min_rating}}})
+
+    if request.min_hygiene:
+        hygiene_hierarchy = [
+            "very good",
+            "good",
+            "acceptable",
+            "needs improvement",
+            "bad",
+            "very bad",
+        ]
+
+        try:
+            min_index = hygiene_hierarchy.index(request.min_hygiene)
+            acceptable_levels = hygiene_hierarchy[: min_index + 1]
+            filters["hygiene"].append({"terms": {"hygiene": acceptable_levels}})
+        except ValueError:
+            filters["hygiene"].append({"terms": {"hygiene": ["acceptable"]}})
+
+    if request.dietary_preferences:
+        for pref, value in request.dietary_preferences.dict(exclude_unset=True).items():
+            if value:
+                filters["dietary"].append({"term": {f"dietary_options.{pref}": True}})
+
+    return filters
+
+
+def _build_query(request: SearchRequest, post_filtered: Collection[str] = ()) -> dict:
+    """
+    Bool query of request. The filters of the facets in post_filtered are
+    left out, for the caller to apply as a post_filter.
+    """
     query = {"bool": {"must": [], "filter": []}}
 
     if request.query:
@@ -79,66 +411,140 @@ async def search(request: SearchRequest) -> SearchResponse:
             }
         )
 
-    if request.cuisine_types:
-        query["bool"]["filter"].append({"terms": {"cuisines": request.cuisine_types}})
-
-    if request.min_rating is not None:
-        query["bool"]["filter"].append(
-            {"range": {"rating": {"gte": request.min_rating}}}
-        )
+    for facet, filters in _facet_filters(request).items():
+        if facet not in post_filtered:
+            query["bool"]["filter"].extend(filters)
 
     if request.min_quality is not None:
         query["bool"]["filter"].append(
             {"range": {"quality": {"gte": request.min_quality}}}
         )
 
-    if request.min_hygiene:
-        hygiene_hierarchy = [
-            "very good",
-            "good",
-            "acceptable",
-            "needs improvement",
-            "bad",
-            "very bad",
-        ]
-
-        try:
-            min_index = hygiene_hierarchy.index(request.min_hygiene)
-            acceptable_levels = hygiene_hierarchy[: min_index + 1]
-            query["bool"]["filter"].append({"terms": {"hygiene": acceptable_levels}})
-        except ValueError:
-            query["bool"]["filter"].append({"terms": {"hygiene": ["acceptable"]}})
-
-    if request.dietary_preferences:
-        for pref, value in request.dietary_preferences.dict(exclude_unset=True).items():
-            if value:
-                query["bool"]["filter"].append(
-                    {"term": {f"dietary_options.{pref}": True}}
-                )
-
     if request.location:
         query["bool"]["filter"].append(
             {"match": {"location": {"query": request.location, "operator": "and"}}}
         )
 
+    if request.near and request.near.radius_km is not None:
+        query["bool"]["filter"].append(
+            {
+                "geo_distance": {
+                    "distance": f"{request.near.radius_km}km",
+                    "geo_location": _geo_point(request.near.center),
+                }
+            }
+        )
+
+    if request.bounding_box:
+        query["bool"]["filter"].append(
+            {
+                "geo_bounding_box": {
+                    "geo_location": {
+                        "top_left": _geo_point(request.bounding_box.top_left),
+                        "bottom_right": _geo_point(request.bounding_box.bottom_right),
+                    }
+                }
+            }
+        )
+
     if not query["bool"]["must"] and not query["bool"]["filter"]:
         query = {"match_all": {}}
 
-    from_val = (request.page - 1) * request.page_size
+    return query
 
-    response = es.search(
-        index=RESTAURANT_INDEX_NAME,
-        query=query,
-        from_=from_val,
-        size=request.page_size,
-        sort=[
-            {"rating": {"order": "desc"}},
-            {"quality": {"order": "desc"}},
-            {"name.keyword": {"order": "asc"}},  # For consistent ordering
-        ],
-        timeout="30s",
-        track_total_hits=True,
-    )
+
+def _encode_cursor(pit_id: str, search_after: list, total: int, relation: str) -> str:
+    cursor = {"pit": pit_id, "after": search_after, "total": total, "rel": relation}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(token: str) -> dict:
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        if not {"pit", "after", "total", "rel"} <= cursor.keys():
+            raise ValueError(token)
+        return cursor
+    except (AttributeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        )
+
+
+async def _search(es: AsyncElasticsearch, request: SearchRequest) -> SearchResponse:
+    """
+    Run the search for request.
+
+    Without a cursor this pages with from/size. In cursor mode the search
+    runs against a point in time and continues with search_after from the
+    last hit's sort values, so every page costs the same as the first; the
+    total is counted once, on the first page, and carried in the cursor.
+
+    Requested facets are counted in the same request, also on the first
+    page only: their filters move to the post_filter and each facet's
+    aggregation applies the filters of all the other facets, so a facet
+    counts what selecting one of its values would add.
+    """
+    facets = [] if request.cursor else sorted(set(request.facets or []))
+    params = {
+        "query": _build_query(request, post_filtered=facets),
+        "size": request.page_size,
+        "source_excludes": SOURCE_EXCLUDES,
+    }
+    if facets:
+        facet_filters = _facet_filters(request)
+        post_filter = [f for facet in facets for f in facet_filters[facet]]
+        if post_filter:
+            params["post_filter"] = {"bool": {"filter": post_filter}}
+        params["aggs"] = {
+            facet: {
+                "filter": {
+                    "bool": {
+                        "filter": [
+                            f
+                            for other in facets
+                            if other != facet
+                            for f in facet_filters[other]
+                        ]
+                    }
+                },
+                "aggs": {"counts": FACET_AGGREGATIONS[facet]},
+            }
+            for facet in facets
+        }
+    track_total_hits = True if request.exact_total else TOTAL_HITS_CAP
+    cursor = None
+    pit_id = None
+
+    if request.cursor:
+        cursor = _decode_cursor(request.cursor)
+        pit_id = cursor["pit"]
+        params.update(search_after=cursor["after"], track_total_hits=False)
+    elif request.with_cursor:
+        pit = await es.open_point_in_time(
+            index=RESTAURANT_INDEX_NAME, keep_alive=CURSOR_KEEP_ALIVE
+        )
+        pit_id = pit["id"]
+        params["track_total_hits"] = track_total_hits
+    else:
+        params.update(
+            index=RESTAURANT_INDEX_NAME,
+            from_=(request.page - 1) * request.page_size,
+            track_total_hits=track_total_hits,
+        )
+
+    if pit_id is not None:
+        params["pit"] = {"id": pit_id, "keep_alive": CURSOR_KEEP_ALIVE}
+
+    try:
+        response = await es.search(**params, sort=_sort(request), timeout="30s")
+    except NotFoundError:
+        if cursor is None:
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Cursor expired, start the search again",
+        )
 
     if "hits" not in response:
         raise HTTPException(
@@ -147,15 +553,49 @@ async def search(request: SearchRequest) -> SearchResponse:
         )
 
     hits = response["hits"]
-    total = hits["total"]["value"] if isinstance(hits["total"], dict) else hits["total"]
+    if cursor is not None:
+        total, relation = cursor["total"], cursor["rel"]
+    elif isinstance(hits["total"], dict):
+        total, relation = hits["total"]["value"], hits["total"]["relation"]
+    else:
+        total, relation = hits["total"], "eq"
 
     restaurants = []
     for hit in hits["hits"]:
-        restaurants.append(Restaurant(**hit["_source"]))
+        restaurant = Restaurant(**hit["_source"])
+        # restaurants without a point sort last, at an infinite distance
+        if request.near and math.isfinite(hit["sort"][0]):
+            restaurant.distance_km = hit["sort"][0]
+        restaurants.append(restaurant)
+
+    next_cursor = None
+    if pit_id is not None:
+        # the point in time id may change between requests
+        pit_id = response.get("pit_id", pit_id)
+        if len(hits["hits"]) == request.page_size:
+            last_sort = hits["hits"][-1]["sort"]
+            next_cursor = _encode_cursor(pit_id, last_sort, total, relation)
+        else:
+            await es.options(ignore_status=404).close_point_in_time(id=pit_id)
+
+    facet_counts = None
+    if facets:
+        facet_counts = {}
+        for facet in facets:
+            buckets = response["aggregations"][facet]["counts"]["buckets"]
+            if isinstance(buckets, dict):
+                buckets = [{"key": k, **bucket} for k, bucket in buckets.items()]
+            facet_counts[facet] = [
+                FacetCount(value=str(bucket["key"]), count=bucket["doc_count"])
+                for bucket in buckets
+            ]
 
     return SearchResponse(
         total=total,
+        total_relation=relation,
         page=request.page,
         page_size=request.page_size,
         results=restaurants,
+        next_cursor=next_cursor,
+        facets=facet_counts,
     )
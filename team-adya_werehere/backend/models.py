@@ -1,6 +1,7 @@
 from enum import Enum
+from typing import Literal
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 
 class HygieneLevel(str, Enum):
@@ -17,6 +18,28 @@ class Coordinates(BaseModel):
     lng: float | None = None
 
 
+class GeoPoint(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lng: float = Field(ge=-180, le=180)
+
+
+class GeoCircle(BaseModel):
+    center: GeoPoint
+    # Without a radius results are only sorted by distance from center
+    radius_km: float | None = Field(None, gt=0)
+
+
+class GeoBoundingBox(BaseModel):
+    top_left: GeoPoint
+    bottom_right: GeoPoint
+
+    @model_validator(mode="after")
+    def check_corners(self):
+        if self.top_left.lat < self.bottom_right.lat:
+            raise ValueError("top_left must not be south of bottom_right")
+        return self
+
+
 class Contact(BaseModel):
     phone: str | None = ""
     email: str | None = ""
@@ -43,6 +66,20 @@ class Restaurant(BaseModel):
     quality: float | None = 0.0
     hygiene: HygieneLevel
     coords: Coordinates | None = None
+    # Distance from SearchRequest.near, when given
+    distance_km: float | None = None
+    # Where a route search met the restaurant: how far along the route, and
+    # how far off it
+    route_position_km: float | None = None
+    route_distance_m: float | None = None
+
+
+FacetName = Literal["cuisines", "hygiene", "dietary", "rating"]
+
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
 
 
 class SearchRequest(BaseModel):
@@ -53,12 +90,64 @@ class SearchRequest(BaseModel):
     min_hygiene: HygieneLevel | None = None
     dietary_preferences: DietaryOptions | None = None
     location: str | None = None
+    near: GeoCircle | None = None
+    bounding_box: GeoBoundingBox | None = None
     page: int = Field(default=1, gt=0)
     page_size: int = Field(default=10, gt=0, le=100)
+    # Count every match instead of stopping at TOTAL_HITS_CAP
+    exact_total: bool = False
+    # Page with a point-in-time cursor instead of page numbers: with_cursor
+    # starts, cursor (a previous next_cursor, sent with the same filters)
+    # continues
+    with_cursor: bool = False
+    cursor: str | None = None
+    # Count matches per value of these fields, ignoring the field's own filter
+    facets: list[FacetName] | None = None
 
 
 class SearchResponse(BaseModel):
     total: int
+    # "gte" when total is only a lower bound (counting stopped at the cap)
+    total_relation: Literal["eq", "gte"] = "eq"
     page: int
     page_size: int
     results: list[Restaurant]
+    next_cursor: str | None = None
+    facets: dict[FacetName, list[FacetCount]] | None = None
+
+
+class RouteSearchRequest(BaseModel):
+    # HERE flexible polyline (routes[].sections[].polyline); several sections
+    # are joined in order
+    polyline: str | list[str] | None = None
+    points: list[GeoPoint] | None = None
+    width_m: float = Field(default=500, gt=0, le=50_000)
+    # Text and attribute filters as for /api/v1/search; paging is ignored
+    filters: SearchRequest | None = None
+    max_results: int = Field(default=100, gt=0, le=1000)
+
+    @model_validator(mode="after")
+    def check_route(self):
+        if (self.polyline is None) == (self.points is None):
+            raise ValueError("Give either polyline or points")
+        if self.points is not None and not self.points:
+            raise ValueError("points must not be empty")
+        return self
+
+
+class RouteSearchResponse(BaseModel):
+    route_length_km: float
+    # True when the corridor held more than max_results restaurants; the
+    # best rated ones are returned. Also set when the search stopped after
+    # ROUTE_CANDIDATES_CAP candidates without finding them all
+    truncated: bool
+    results: list[Restaurant]
+
+
+class Suggestion(BaseModel):
+    text: str
+    type: Literal["name", "cuisine", "location"]
+
+
+class SuggestResponse(BaseModel):
+    suggestions: list[Suggestion]
@@ -0,0 +1,242 @@
+import math
+from collections.abc import Iterator, Sequence
+
+EARTH_RADIUS_M = 6_371_008.8
+
+# (x, y) in metres on a corridor's local plane
+Point = tuple[float, float]
+
+# Upper bound on the segments of a simplified route, i.e. on the geo_shape
+# clauses of one corridor query
+MAX_CORRIDOR_SEGMENTS = 256
+
+_FLEXIBLE_POLYLINE_ALPHABET = (
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+)
+_FLEXIBLE_POLYLINE_VALUES = {c: i for i, c in enumerate(_FLEXIBLE_POLYLINE_ALPHABET)}
+
+
+def _unsigned_varints(encoded: str) -> Iterator[int]:
+    value, shift = 0, 0
+    for char in encoded:
+        try:
+            chunk = _FLEXIBLE_POLYLINE_VALUES[char]
+        except KeyError:
+            raise ValueError(f"Invalid flexible polyline character {char!r}")
+        value |= (chunk & 0x1F) << shift
+        if chunk & 0x20:
+            shift += 5
+        else:
+            yield value
+            value, shift = 0, 0
+    if shift:
+        raise ValueError("Truncated flexible polyline")
+
+
+def _signed(value: int) -> int:
+    return ~(value >> 1) if value & 1 else value >> 1
+
+
+def decode_flexible_polyline(encoded: str) -> list[tuple[float, float]]:
+    """
+    (lat, lng) points of a HERE flexible polyline, as returned in
+    routes[].sections[].polyline by the HERE Routing API. A third
+    dimension (elevation, level, ...) is decoded and dropped.
+    """
+    values = _unsigned_varints(encoded)
+    if next(values, None) != 1:
+        raise ValueError("Unsupported flexible polyline version")
+    header = next(values, None)
+    if header is None:
+        raise ValueError("Truncated flexible polyline")
+    factor = 10 ** (header & 0x0F)
+    dimensions = 3 if (header >> 4) & 0x07 else 2
+
+    points = []
+    last = [0] * dimensions
+    deltas = list(values)
+    if len(deltas) % dimensions:
+        raise ValueError("Truncated flexible polyline")
+    for start in range(0, len(deltas), dimensions):
+        for i in range(dimensions):
+            last[i] += _signed(deltas[start + i])
+        points.append((last[0] / factor, last[1] / factor))
+    return points
+
+
+def _simplify(xy: Sequence[tuple[float, float]], tolerance: float) -> list[int]:
+    """Indices of the points Douglas-Peucker keeps at tolerance (in xy units)."""
+    keep = [False] * len(xy)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (ax, ay), (bx, by) = xy[first], xy[last]
+        dx, dy = bx - ax, by - ay
+        length2 = dx * dx + dy * dy
+        # compare squared distances to the chord, clamped to its ends
+        farthest, max_distance2 = None, tolerance * tolerance
+        for i in range(first + 1, last):
+            px, py = xy[i][0] - ax, xy[i][1] - ay
+            t = (px * dx + py * dy) / length2 if length2 else 0.0
+            t = 0.0 if t < 0 else 1.0 if t > 1 else t
+            ex, ey = px - t * dx, py - t * dy
+            distance2 = ex * ex + ey * ey
+            if distance2 > max_distance2:
+                farthest, max_distance2 = i, distance2
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [i for i, kept in enumerate(keep) if kept]
+
+
+def _lerp(a: Point, b: Point, t: float) -> Point:
+    return a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1])
+
+
+class RouteCorridor:
+    """
+    The area within width_m of a route, for one indexed geo query.
+
+    The route is projected once onto a local equirectangular plane (metres,
+    centred on the route's mean latitude) and simplified with Douglas-Peucker
+    to at most MAX_CORRIDOR_SEGMENTS segments; the tolerance starts at a
+    quarter of the width and doubles until the route fits. Every point of the
+    route is within that tolerance of the simplified route, so the query
+    shapes are built around the simplified route at width_m plus the
+    tolerance. Distances and positions along the route are measured on the
+    original route; the simplified one only narrows down where to look.
+    """
+
+    def __init__(self, points: Sequence[tuple[float, float]], width_m: float):
+        if not points:
+            raise ValueError("A route needs at least one point")
+        self.width_m = width_m
+
+        lat0 = math.radians(sum(lat for lat, _ in points) / len(points))
+        self._ky = math.radians(EARTH_RADIUS_M)
+        self._kx = self._ky * math.cos(lat0)
+
+        xy = [self._to_xy(lat, lng) for lat, lng in points]
+        self._xy = [p for i, p in enumerate(xy) if i == 0 or p != xy[i - 1]]
+        tolerance = width_m / 4
+        kept = _simplify(self._xy, tolerance) if len(self._xy) > 1 else [0]
+        while len(kept) - 1 > MAX_CORRIDOR_SEGMENTS:
+            tolerance *= 2
+            kept = _simplify(self._xy, tolerance)
+        self.simplify_tolerance_m = tolerance
+        # indices into _xy of the simplified route's vertices
+        self._kept = kept
+
+        self._offsets = [0.0]
+        for a, b in zip(self._xy, self._xy[1:]):
+            self._offsets.append(self._offsets[-1] + math.dist(a, b))
+
+        # grid of width_m cells listing the route segments passing through
+        # each, so locate only measures the segments near a point
+        self._cell = width_m
+        self._grid: dict[tuple[int, int], list[int]] = {}
+        for i, (a, b) in enumerate(zip(self._xy, self._xy[1:])):
+            cells = set()
+            # pieces of at most one cell, so a long segment is not entered
+            # into every cell of its bounding box
+            pieces = max(1, math.ceil(math.dist(a, b) / self._cell))
+            for k in range(pieces):
+                x0, y0 = _lerp(a, b, k / pieces)
+                x1, y1 = _lerp(a, b, (k + 1) / pieces)
+                cell_of = self._cell_of
+                columns = range(cell_of(min(x0, x1)), cell_of(max(x0, x1)) + 1)
+                rows = range(cell_of(min(y0, y1)), cell_of(max(y0, y1)) + 1)
+                cells.update((cx, cy) for cx in columns for cy in rows)
+            for cell in cells:
+                self._grid.setdefault(cell, []).append(i)
+
+    @property
+    def length_m(self) -> float:
+        return self._offsets[-1]
+
+    def _cell_of(self, coordinate: float) -> int:
+        return math.floor(coordinate / self._cell)
+
+    def _to_xy(self, lat: float, lng: float) -> tuple[float, float]:
+        return lng * self._kx, lat * self._ky
+
+    def _to_lng_lat(self, x: float, y: float) -> list[float]:
+        return [x / self._kx, y / self._ky]
+
+    def _simplified_segments(self) -> list[tuple[Point, Point]]:
+        return [
+            (self._xy[first], self._xy[last])
+            for first, last in zip(self._kept, self._kept[1:])
+        ]
+
+    def polygons(self) -> list[list[list[float]]]:
+        """
+        GeoJSON rings ([lng, lat], counter-clockwise) whose union covers the
+        corridor: per simplified segment a rectangle reaching width_m plus
+        the simplification tolerance to either side and beyond both ends, so
+        the joints are covered too.
+        """
+        segments = self._simplified_segments()
+        if not segments:
+            segments = [(self._xy[0], self._xy[0])]
+        w = self.width_m + self.simplify_tolerance_m
+        rings = []
+        for (ax, ay), (bx, by) in segments:
+            length = math.hypot(bx - ax, by - ay)
+            # along and across unit vectors; any direction for a single point
+            ux, uy = 1.0, 0.0
+            if length:
+                ux, uy = (bx - ax) / length, (by - ay) / length
+            nx, ny = -uy, ux
+            start = (ax - ux * w, ay - uy * w)
+            end = (bx + ux * w, by + uy * w)
+            corners = [
+                (start[0] - nx * w, start[1] - ny * w),
+                (end[0] - nx * w, end[1] - ny * w),
+                (end[0] + nx * w, end[1] + ny * w),
+                (start[0] + nx * w, start[1] + ny * w),
+            ]
+            ring = [self._to_lng_lat(x, y) for x, y in corners]
+            rings.append(ring + [ring[0]])
+        return rings
+
+    def locate(self, lat: float, lng: float) -> tuple[float, float] | None:
+        """
+        (metres along the route, metres from it) of the closest point of the
+        route, or None when the point is outside the corridor.
+        """
+        p = self._to_xy(lat, lng)
+        if len(self._xy) == 1:
+            distance = math.dist(p, self._xy[0])
+            return (0.0, distance) if distance <= self.width_m else None
+
+        # any segment within width_m of p passes through p's cell or a neighbour
+        cx, cy = self._cell_of(p[0]), self._cell_of(p[1])
+        nearby = {
+            i
+            for x in (cx - 1, cx, cx + 1)
+            for y in (cy - 1, cy, cy + 1)
+            for i in self._grid.get((x, y), ())
+        }
+
+        best, best_distance2 = None, self.width_m * self.width_m
+        for i in sorted(nearby):
+            (ax, ay), (bx, by) = self._xy[i], self._xy[i + 1]
+            dx, dy = bx - ax, by - ay
+            px, py = p[0] - ax, p[1] - ay
+            length2 = dx * dx + dy * dy
+            t = (px * dx + py * dy) / length2 if length2 else 0.0
+            t = 0.0 if t < 0 else 1.0 if t > 1 else t
+            ex, ey = px - t * dx, py - t * dy
+            distance2 = ex * ex + ey * ey
+            # a segment at exactly width_m still counts
+            at_edge = best is None and distance2 == best_distance2
+            if distance2 < best_distance2 or at_edge:
+                best, best_distance2 = (i, t), distance2
+        if best is None:
+            return None
+        i, t = best
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return start + t * (end - start), math.sqrt(best_distance2)
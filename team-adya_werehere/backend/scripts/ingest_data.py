@@ -1,7 +1,14 @@
+import argparse
+import hashlib
 import json
+import re
 import sys
+import time
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, cast
 
-from elasticsearch import Elasticsearch
+from elasticsearch import ApiError, ConnectionError, ConnectionTimeout, Elasticsearch
 from tqdm import tqdm
 
 sys.path.append("../backend")
@@ -87,7 +94,13 @@ RESTAURANT_INDEX_MAPPING = {
             "type": "text",
             "analyzer": "cuisine_analyzer",
             "fields": {
-                "keyword": {"type": "keyword", "normalizer": "lowercase_normalizer"},
+                # global ordinals for the cuisines facet are built at refresh,
+                # not on the first search after it
+                "keyword": {
+                    "type": "keyword",
+                    "normalizer": "lowercase_normalizer",
+                    "eager_global_ordinals": True,
+                },
                 "edge_ngram": {
                     "type": "text",
                     "analyzer": "edge_ngram_analyzer",
@@ -112,48 +125,284 @@ RESTAURANT_INDEX_MAPPING = {
             "ignore_above": 256,
             "normalizer": "lowercase",
             "null_value": "acceptable",
+            "eager_global_ordinals": True,
         },
-        "coordinates": {
+        "coords": {
             "properties": {"lat": {"type": "float"}, "lng": {"type": "float"}},
         },
+        # coords as a point, for distance and bounding box filters and sorting
+        "geo_location": {"type": "geo_point"},
+        # Prefix suggestions for /api/v1/suggest, weighted by rating
+        "name_suggest": {"type": "completion"},
+        "cuisine_suggest": {"type": "completion"},
+        "location_suggest": {"type": "completion"},
     }
 }
 
 
-def index_data(documents: list[dict]):
+MGET_BATCH_SIZE = 1000
+
+# Seconds to wait for the force merge and for the new index to turn yellow
+MERGE_TIMEOUT = 3600
+HEALTH_TIMEOUT = 60
+
+# Name suggestions match from each of the first few words of the name on
+NAME_SUGGEST_MAX_INPUTS = 5
+# Location suggestions are the last address parts: typically neighbourhood,
+# locality, city and state
+LOCATION_SUGGEST_MAX_INPUTS = 4
+
+# Bulk item statuses worth sending again: rejected under load or a shard hiccup
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+_SEPARATORS = re.compile(r"[\s,]*")
+_PIN_CODE = re.compile(r"\b\d{6}\b")
+_LANDMARK = re.compile(
+    r"(near|opp|opposite|next to|behind|beside|above|below)\b", re.IGNORECASE
+)
+# Text after a decoded value that may be the rest of a number cut at a block boundary
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+
+def index_data(
+    documents: Iterable[dict],
+    incremental: bool = False,
+    chunk_docs: int = 500,
+    chunk_bytes: int = 5 * 1024 * 1024,
+    threads: int = 4,
+    max_retries: int = 3,
+    replicas: int = 1,
+    keep_versions: int = 0,
+    max_failures: int | None = None,
+):
+    """
+    Index the restaurants, one document per normalized name.
+
+    By default a new versioned index (RESTAURANT_INDEX_NAME_v{n}) is built
+    and, once it is complete, swapped in behind the RESTAURANT_INDEX_NAME
+    alias that the API queries, so searches never see a partial index.
+    With incremental=True the index behind the alias is kept and only
+    restaurants whose name is not indexed yet are added. documents may be
+    any iterable, e.g. _iter_json_array, and is consumed in a single
+    streaming pass.
+
+    Documents that cannot be indexed are reported and the new index is
+    swapped in without them, unless there are more than max_failures of
+    them (None: no limit); then it is deleted and the alias left alone.
+    """
     es = get_es_client()
 
     if es is None:
         print("Indexing failed: no elasticsearch instance connected")
         return
 
-    response = _create_index(es)
-    if "acknowledged" not in response:
-        print("Indexing failed: index creation error")
-        print(response)
-        return
+    if incremental and es.indices.exists(index=RESTAURANT_INDEX_NAME):
+        index = RESTAURANT_INDEX_NAME
+    else:
+        incremental = False
+        index = f"{RESTAURANT_INDEX_NAME}_v{_latest_version(es) + 1}"
+        response = _create_index(es, index)
+        if "acknowledged" not in response:
+            print("Indexing failed: index creation error")
+            print(response)
+            return
 
-    response = _index_documents(es, documents)
-    if response["errors"]:
-        print("Indexing failed: bulk insertion error")
-        print(response)
-        return
+    start = time.perf_counter()
+    try:
+        response = _index_documents(
+            es, index, documents, incremental, chunk_docs, chunk_bytes, threads, max_retries
+        )
+    except Exception:
+        if not incremental:
+            es.indices.delete(index=index, ignore_unavailable=True)
+        raise
+    seconds = time.perf_counter() - start
+    failed = response["items"]
+    if failed:
+        print(f"{len(failed)} documents could not be indexed, e.g.:")
+        print(failed[:10])
+        if max_failures is not None and len(failed) > max_failures:
+            print(f"Indexing failed: more than {max_failures} failed documents")
+            if not incremental:
+                es.indices.delete(index=index, ignore_unavailable=True)
+                print(
+                    f"Deleted {index}; {RESTAURANT_INDEX_NAME} still points at the previous index"
+                )
+            return
 
     print(
-        f"Indexed {len(documents)} documents into Elasticsearch Index {RESTAURANT_INDEX_NAME}"
+        f"Indexed {response['created']} documents into Elasticsearch Index {index}"
+        f" ({response['skipped']} duplicates or already indexed)"
+        f" in {seconds:.1f}s ({response['created'] / max(seconds, 1e-9):.0f} docs/s)"
     )
 
+    if incremental:
+        es.indices.refresh(index=index)
+        _mark_loaded(es, index)
+    else:
+        _finalize_index(es, index, replicas)
+        _mark_loaded(es, index)
+        _swap_alias(es, index)
+        _delete_old_versions(es, index, keep_versions)
+
+
+def _mark_loaded(es: Elasticsearch, index: str):
+    """
+    Record the load time in the index's mapping metadata. The API's search
+    cache keys on it, so searches cached before this load are not served.
+    """
+    es.indices.put_mapping(index=index, meta={"loaded_at": time.time()})
+
+
+def _versions(es: Elasticsearch) -> dict[str, int]:
+    """Existing versioned restaurant indices and their version numbers."""
+    pattern = re.compile(rf"^{re.escape(RESTAURANT_INDEX_NAME)}_v(\d+)$")
+    indices = es.indices.get(index=f"{RESTAURANT_INDEX_NAME}_v*", expand_wildcards="all")
+    return {
+        name: int(match.group(1))
+        for name in indices
+        if (match := pattern.match(name))
+    }
+
 
-def _create_index(es: Elasticsearch) -> dict:
-    es.indices.delete(index=RESTAURANT_INDEX_NAME, ignore_unavailable=True)
+def _latest_version(es: Elasticsearch) -> int:
+    return max(_versions(es).values(), default=0)
+
+
+def _create_index(es: Elasticsearch, index: str) -> dict:
+    """
+    Create a versioned index tuned for the bulk load: no periodic refresh
+    and no replicas to copy every document to; _finalize_index restores both.
+    """
     response = es.indices.create(
-        index=RESTAURANT_INDEX_NAME,
+        index=index,
         mappings=RESTAURANT_INDEX_MAPPING,
-        settings=RESTAURANT_INDEX_SETTINGS,
+        settings={
+            **RESTAURANT_INDEX_SETTINGS,
+            "index": {"refresh_interval": "-1", "number_of_replicas": 0},
+        },
     )
     return response.body
 
 
+def _finalize_index(es: Elasticsearch, index: str, replicas: int):
+    """Restore search settings on a freshly loaded index, merge and warm it."""
+    es.indices.put_settings(
+        index=index,
+        settings={"index": {"refresh_interval": None, "number_of_replicas": replicas}},
+    )
+    es.indices.refresh(index=index)
+
+    # both calls can outlast the client's default request timeout on a large
+    # index; resending them on timeout would only repeat the work
+    try:
+        es.options(request_timeout=MERGE_TIMEOUT, max_retries=0).indices.forcemerge(
+            index=index, max_num_segments=1
+        )
+    except ConnectionTimeout:
+        print(f"Force merge of {index} still running after {MERGE_TIMEOUT}s; continuing")
+    health = es.options(
+        request_timeout=HEALTH_TIMEOUT + 10, max_retries=0, ignore_status=408
+    ).cluster.health(index=index, wait_for_status="yellow", timeout=f"{HEALTH_TIMEOUT}s")
+    if health.body.get("timed_out"):
+        print(f"{index} is still {health.body.get('status')} after {HEALTH_TIMEOUT}s; continuing")
+
+    # run the API's default sort once so its doc values are loaded before traffic arrives
+    es.search(
+        index=index,
+        query={"match_all": {}},
+        size=10,
+        sort=[
+            {"rating": {"order": "desc"}},
+            {"quality": {"order": "desc"}},
+            {"name.keyword": {"order": "asc"}},
+        ],
+    )
+
+
+def _swap_alias(es: Elasticsearch, index: str):
+    """
+    Point the RESTAURANT_INDEX_NAME alias at `index` in one atomic update. A
+    concrete index still named RESTAURANT_INDEX_NAME, from before indices
+    were versioned, is removed in the same update.
+    """
+    actions = [{"add": {"index": index, "alias": RESTAURANT_INDEX_NAME}}]
+    if es.indices.exists_alias(name=RESTAURANT_INDEX_NAME):
+        current = es.indices.get_alias(name=RESTAURANT_INDEX_NAME)
+        actions += [
+            {"remove": {"index": name, "alias": RESTAURANT_INDEX_NAME}}
+            for name in current
+            if name != index
+        ]
+    elif es.indices.exists(index=RESTAURANT_INDEX_NAME):
+        actions.append({"remove_index": {"index": RESTAURANT_INDEX_NAME}})
+
+    es.indices.update_aliases(actions=actions)
+    print(f"{RESTAURANT_INDEX_NAME} now points at {index}")
+
+
+def _delete_old_versions(es: Elasticsearch, index: str, keep_versions: int):
+    """Delete all but the keep_versions newest versioned indices older than `index`."""
+    versions = _versions(es)
+    older = sorted(
+        (name for name in versions if versions[name] < versions[index]),
+        key=lambda name: versions[name],
+        reverse=True,
+    )
+    for name in older[keep_versions:]:
+        es.indices.delete(index=name)
+        print(f"Deleted old index {name}")
+
+
+def _iter_json_array(path: str, block_size: int = 1 << 16) -> Iterator[dict]:
+    """
+    Yield the elements of the JSON array in `path` one at a time, reading
+    the file in blocks of block_size characters, so memory does not grow
+    with the file.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+
+        def refill() -> bool:
+            nonlocal buffer, pos, eof
+            block = f.read(block_size)
+            eof = not block
+            buffer, pos = buffer[pos:] + block, 0
+            return not eof
+
+        while not buffer.lstrip() and refill():
+            pass
+        buffer = buffer.lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not contain a JSON array")
+        pos = 1
+
+        while True:
+            separators = _SEPARATORS.match(buffer, pos)
+            if separators is not None:
+                pos = separators.end()
+            if pos == len(buffer):
+                if not refill():
+                    raise ValueError(f"{path}: unexpected end of file inside the array")
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # most likely an element cut at the block boundary
+                if eof or not refill():
+                    raise
+                continue
+            if not eof and _NUMBER_TAIL.fullmatch(buffer, end):
+                # the value may continue in the next block, e.g. "23" of "23.5"
+                refill()
+                continue
+            pos = end
+            yield element
+
+
 def _preprocess_document(doc: dict) -> dict:
     processed = doc.copy()
 
@@ -162,44 +411,279 @@ def _preprocess_document(doc: dict) -> dict:
             if processed["contact"].get(field) in ["None", None]:
                 processed["contact"][field] = ""
 
+    coords = processed.get("coords") or {}
+    lat, lng = coords.get("lat"), coords.get("lng")
+    # (0, 0) marks a restaurant that was never geocoded
+    if lat is not None and lng is not None and (lat, lng) != (0, 0):
+        processed["geo_location"] = {"lat": lat, "lon": lng}
+
+    # completion weights are integers; better rated restaurants come first
+    weight = 1 + round(20 * (processed.get("rating") or 0))
+    words = processed.get("name", "").split()
+    if words:
+        inputs = [" ".join(words[i:]) for i in range(len(words))]
+        processed["name_suggest"] = {
+            "input": inputs[:NAME_SUGGEST_MAX_INPUTS],
+            "weight": weight,
+        }
+    cuisines = [c for c in processed.get("cuisines") or [] if c and c.strip()]
+    if cuisines:
+        processed["cuisine_suggest"] = {"input": cuisines, "weight": weight}
+    localities = _localities(processed.get("location") or "")
+    if localities:
+        processed["location_suggest"] = {"input": localities, "weight": weight}
+
     return processed
 
 
-def _index_documents(es: Elasticsearch, documents: list[dict]) -> dict:
-    operation = []
-    indexed_names = set()
+def _localities(location: str) -> list[str]:
+    """
+    Locality parts of an address, e.g. ["Parsi Colony", "Andheri West",
+    "Mumbai", "Maharashtra"]: the last comma-separated parts without the PIN
+    code and country, skipping house numbers and landmarks ("opp. ...").
+    """
+    parts = {}
+    for part in location.split(","):
+        part = " ".join(_PIN_CODE.sub(" ", part).split())
+        if not part or part.lower() == "india" or part[0].isdigit():
+            continue
+        if _LANDMARK.match(part):
+            continue
+        parts.setdefault(part.lower(), part)
+    return list(parts.values())[-LOCATION_SUGGEST_MAX_INPUTS:]
+
+
+def _document_id(name: str) -> str:
+    """
+    Deterministic document id of a restaurant: the SHA-1 of its name,
+    lowercased with whitespace collapsed, so duplicates map to one id.
+    """
+    normalized = " ".join(name.split()).lower()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
 
-    for document in tqdm(documents, total=len(documents), desc="Processing Documents"):
+
+def _existing_ids(es: Elasticsearch, index: str, ids: list[str]) -> set[str]:
+    """Ids already in the index, looked up with one mget per MGET_BATCH_SIZE ids."""
+    existing = set()
+    for start in range(0, len(ids), MGET_BATCH_SIZE):
+        response = es.mget(
+            index=index,
+            ids=ids[start : start + MGET_BATCH_SIZE],
+            source=False,
+        )
+        existing.update(doc["_id"] for doc in response["docs"] if doc.get("found"))
+    return existing
+
+
+def _prepared_documents(
+    documents: Iterable[dict], counts: dict
+) -> Iterator[tuple[str, dict]]:
+    """
+    Yield (id, preprocessed document) for each restaurant with a name,
+    dropping repeats of an id so the first occurrence wins. Only the first
+    64 bits of each seen id are kept in memory, as an int.
+    """
+    seen = set()
+    for document in documents:
         name = document.get("name", "").strip()
-        if not name or name in indexed_names:
+        doc_id = _document_id(name) if name else None
+        key = int(doc_id[:16], 16) if doc_id else None
+        if doc_id is None or key in seen:
+            counts["skipped"] += 1
             continue
+        seen.add(key)
+        yield doc_id, _preprocess_document(document)
 
-        exists_query = {
-            "query": {
-                "term": {"name.keyword": {"value": name, "case_insensitive": True}}
-            },
-            "size": 1,
-        }
 
-        search_result = es.search(index=RESTAURANT_INDEX_NAME, body=exists_query)
+def _chunk_actions(
+    prepared: Iterable[tuple[str, dict]], chunk_docs: int, chunk_bytes: int
+) -> Iterator[list[tuple[str, bytes]]]:
+    """
+    Group serialized bulk create actions into chunks of at most chunk_docs
+    documents and chunk_bytes bytes (a single larger document is sent alone).
+    """
+    chunk, size = [], 0
+    for doc_id, document in prepared:
+        payload = (
+            json.dumps({"create": {"_id": doc_id}}) + "\n" + json.dumps(document) + "\n"
+        ).encode("utf-8")
+        if chunk and (len(chunk) >= chunk_docs or size + len(payload) > chunk_bytes):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((doc_id, payload))
+        size += len(payload)
+    if chunk:
+        yield chunk
+
+
+def _send_chunk(
+    es: Elasticsearch,
+    index: str,
+    chunk: list[tuple[str, bytes]],
+    incremental: bool,
+    max_retries: int,
+) -> dict:
+    """
+    Bulk-create one chunk. Items rejected with a retryable status are sent
+    again on their own, with exponential backoff, up to max_retries times;
+    after a connection error or timeout the whole chunk is sent again.
+    """
+    start = time.perf_counter()
+    result = {
+        "docs": len(chunk),
+        "bytes": sum(len(payload) for _, payload in chunk),
+        "created": 0,
+        "skipped": 0,
+        "failed": [],
+    }
+
+    if incremental:
+        existing = _existing_ids(es, index, [doc_id for doc_id, _ in chunk])
+        result["skipped"] += len(existing)
+        chunk = [item for item in chunk if item[0] not in existing]
 
-        if search_result["hits"]["total"]["value"] > 0:
+    pending = chunk
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(min(0.5 * 2**attempt, 30))
+
+        try:
+            # the NDJSON serializer sends pre-encoded lines as they are
+            operations = cast(Sequence[Mapping[str, Any]], [p for _, p in pending])
+            # retried here rather than by the transport, to know which attempt
+            # a 409 answers
+            bulk = es.options(max_retries=0).bulk
+            response = bulk(index=index, operations=operations)
+        except (ConnectionError, ConnectionTimeout):
+            continue
+        except ApiError as e:
+            if e.meta.status not in RETRYABLE_STATUSES:
+                raise
             continue
 
-        processed_doc = _preprocess_document(document)
-        operation.append({"index": {}})
-        operation.append(processed_doc)
-        indexed_names.add(name)
+        retry = []
+        for item, outcome in zip(pending, response["items"]):
+            outcome = outcome["create"]
+            if not outcome.get("error"):
+                result["created"] += 1
+            elif outcome["status"] == 409 and attempt:
+                # repeats are dropped before sending, so an id found on a retry
+                # was created by an attempt whose response was lost
+                result["created"] += 1
+            elif outcome["status"] == 409:
+                # create fails for an id that is already indexed, which is the deduplication
+                result["skipped"] += 1
+            elif outcome["status"] in RETRYABLE_STATUSES:
+                retry.append(item)
+            else:
+                result["failed"].append(outcome)
+        pending = retry
 
-    if not operation:
-        return {"errors": False, "items": []}
+    result["failed"].extend(
+        {"_id": doc_id, "error": "retries exhausted"} for doc_id, _ in pending
+    )
+    result["seconds"] = time.perf_counter() - start
+    return result
 
-    response = es.bulk(index=RESTAURANT_INDEX_NAME, operations=operation)
-    return response.body
+
+def _index_documents(
+    es: Elasticsearch,
+    index: str,
+    documents: Iterable[dict],
+    incremental: bool = False,
+    chunk_docs: int = 500,
+    chunk_bytes: int = 5 * 1024 * 1024,
+    threads: int = 4,
+    max_retries: int = 3,
+) -> dict:
+    """
+    Stream documents into the index with parallel bulk requests.
+
+    Chunks are sent from a pool of `threads` threads. At most 2 * threads
+    chunks are in flight or queued; reading the input pauses until one
+    completes, so memory stays bounded however large the input is.
+    """
+    totals = {"created": 0, "skipped": 0, "failed": []}
+    progress = tqdm(documents, desc="Processing Documents", unit="doc")
+    chunks = _chunk_actions(_prepared_documents(progress, totals), chunk_docs, chunk_bytes)
+
+    def collect(done):
+        for future in done:
+            result = future.result()
+            totals["created"] += result["created"]
+            totals["skipped"] += result["skipped"]
+            totals["failed"].extend(result["failed"])
+            tqdm.write(
+                f"Chunk: {result['docs']} docs, {result['bytes'] / 1024:.0f} KB in "
+                f"{result['seconds']:.2f}s ({result['docs'] / max(result['seconds'], 1e-9):.0f} docs/s)"
+            )
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        in_flight = set()
+        for chunk in chunks:
+            if len(in_flight) >= 2 * threads:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(pool.submit(_send_chunk, es, index, chunk, incremental, max_retries))
+        collect(wait(in_flight).done)
+    progress.close()
+
+    return {
+        "errors": bool(totals["failed"]),
+        "items": totals["failed"],
+        "created": totals["created"],
+        "skipped": totals["skipped"],
+    }
 
 
 if __name__ == "__main__":
-    with open("../data/restaurant_review.json") as f:
-        sourced_documents = json.load(f)
+    parser = argparse.ArgumentParser(description="Index restaurant reviews into Elasticsearch.")
+    parser.add_argument(
+        "data",
+        nargs="?",
+        default="../data/restaurant_review.json",
+        help="JSON array of restaurants (default: ../data/restaurant_review.json)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the existing index and only add restaurants that are not indexed yet",
+    )
+    parser.add_argument("--chunk-docs", type=int, default=500, help="Documents per bulk request")
+    parser.add_argument(
+        "--chunk-mb", type=float, default=5, help="Maximum size of a bulk request in MB"
+    )
+    parser.add_argument("--threads", type=int, default=4, help="Parallel bulk requests")
+    parser.add_argument(
+        "--max-retries", type=int, default=3, help="Retries of rejected documents"
+    )
+    parser.add_argument(
+        "--replicas", type=int, default=1, help="Replicas of the new index once it is loaded"
+    )
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        default=None,
+        help="Abandon the new index if more documents than this fail (default: no limit)",
+    )
+    parser.add_argument(
+        "--keep-versions",
+        type=int,
+        default=0,
+        help="Previous index versions kept for rollback after the alias swap",
+    )
+    args = parser.parse_args()
 
-    index_data(documents=sourced_documents)
+    index_data(
+        documents=_iter_json_array(args.data),
+        incremental=args.incremental,
+        chunk_docs=args.chunk_docs,
+        chunk_bytes=int(args.chunk_mb * 1024 * 1024),
+        threads=args.threads,
+        max_retries=args.max_retries,
+        replicas=args.replicas,
+        keep_versions=args.keep_versions,
+        max_failures=args.max_failures,
+    )